@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# run.py - Offline benchmarks of chubbcord against a local stand-in API.
+# --------------------------------------------------
+"""
+Run the benchmarks and compare them with the baselines:
+
+    python benchmarks/run.py                 # fails if a metric regressed
+    python benchmarks/run.py --update        # record the current results as baselines
+
+Nothing reaches Discord: the client talks to `StandInAPI` on 127.0.0.1, and runs
+with a temporary home directory.
+"""
+# Built-in
+import argparse
+import gc
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINES = os.path.join(ROOT, 'benchmarks', 'baselines.json')
+sys.path.insert(0, ROOT)
+
+from benchmarks.standin import StandInAPI  # noqa: E402
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def make_client(api):
+    """
+    :param api: The running `StandInAPI`.
+    :return: a `MyClient` logged in to the stand-in, with a console writing to memory.
+    """
+
+    from rich.console import Console
+    from src import main
+
+    main.API_URL = api.base_url
+    main.LOOKUP_URL = api.lookup_url
+    sys.argv = ['chubbcord', '-t', 'benchmark-token']
+    client = main.MyClient()
+    client.console = Console(file=io.StringIO(), force_terminal=True, width=120)
+
+    return client
+
+
+def bench_startup(options):
+    """
+    Milliseconds from launching a new interpreter to the welcome screen and to the
+    directory being listed, once the caches of a first run are on disk.
+    """
+
+    api = StandInAPI(latency=options.latency, guilds=20, channels_per_guild=15).start()
+    command = [sys.executable, os.path.join(ROOT, 'benchmarks', 'startup.py'), api.base_url, api.lookup_url]
+
+    # The first run ever fills ~/.chubbcord (user agent, profile, directory snapshot)
+    subprocess.run(command, check=True, capture_output=True)
+    started = time.time()
+    child = subprocess.run(command, check=True, capture_output=True, text=True)
+    stamps = json.loads(child.stdout)
+    api.stop()
+
+    return {
+        'startup_to_welcome': ((stamps['welcome'] - started) * 1000, 'ms'),
+        'startup_to_ready': ((stamps['ready'] - started) * 1000, 'ms'),
+    }
+
+
+def bench_poll(options, rate_limit_ratio=0.0):
+    """ Round trip of a poll finding one new message, in milliseconds """
+
+    api = StandInAPI(latency=options.latency, rate_limit_ratio=rate_limit_ratio,
+                     guilds=1, channels_per_guild=1, friends=0).start()
+    client = make_client(api)
+    channel = api.channel_ids[0]
+    client.args.channel = channel
+    client.running = True
+    client.print_messages(client.window_messages())
+
+    timings = []
+    for _ in range(options.polls):
+        api.post(channel)
+        started = time.perf_counter()
+        delta = client.poll_messages(channel)
+        timings.append((time.perf_counter() - started) * 1000)
+        assert len(delta.inserted) == 1, delta
+
+    client.clean()
+    api.stop()
+
+    suffix = '_throttled' if rate_limit_ratio else ''
+    return {
+        f'poll_rtt_median{suffix}': (statistics.median(timings), 'ms'),
+        f'poll_rtt_p95{suffix}': (percentile(timings, 95), 'ms'),
+    }
+
+
+def bench_send(options):
+    """
+    Milliseconds a message typed takes to be printed (as pending), and to be posted,
+    when messages are typed faster than Discord answers, in a polled channel.
+    """
+
+    api = StandInAPI(latency=options.latency, guilds=1, channels_per_guild=1, friends=0).start()
+    client = make_client(api)
+    channel = api.channel_ids[0]
+    client.args.channel = channel
+    client.running = True
+    client.print_messages(client.window_messages())
+    client.scheduler.watch(channel, now=True)
+    client.scheduler.start()
+
+    posted = {}
+    sent = client.on_message_sent
+
+    def on_message_sent(channel, nonce, message):
+        posted[message['content']] = time.perf_counter()
+        sent(channel, nonce, message)
+
+    client.outbox.on_sent = on_message_sent
+
+    echoes = []
+    queued = {}
+    for index in range(options.polls):
+        content = f'message {index}'
+        queued[content] = time.perf_counter()
+        client.queue_message(content)
+        echoes.append((time.perf_counter() - queued[content]) * 1000)
+        time.sleep(options.latency / 4)
+    client.outbox.join()
+
+    deliveries = [(posted[content] - started) * 1000 for content, started in queued.items()]
+    client.clean()
+    api.stop()
+
+    return {
+        'send_echo_p95': (percentile(echoes, 95), 'ms'),
+        'send_posted_median': (statistics.median(deliveries), 'ms'),
+    }
+
+
+def bench_render(options):
+    """ Messages rendered per second by print_messages, first render and memoized """
+
+    from src.model import Message
+    from src.store import MessageDelta
+
+    api = StandInAPI(guilds=1, channels_per_guild=1, friends=0, history=0,
+                     payload_size=options.payload_size).start()
+    client = make_client(api)
+    channel = api.channel_ids[0]
+    client.args.channel = channel
+    client.running = True
+    messages = [Message.from_json(api.message(channel)) for _ in range(options.messages)]
+    # Mentions are known, lookups would only measure the stand-in
+    client.harvest_identities([{'mentions': api.users}])
+
+    results = {}
+    for name in ('render_cold', 'render_memoized'):
+        started = time.perf_counter()
+        client.print_messages(MessageDelta(inserted=messages))
+        elapsed = time.perf_counter() - started
+        results[name] = (len(messages) / elapsed, 'msg/s')
+        client.console.file = io.StringIO()
+
+    client.clean()
+    api.stop()
+
+    return results
+
+
+def bench_memory(options):
+    """ Python heap growth over a long polling session, once warmed up """
+
+    api = StandInAPI(guilds=1, channels_per_guild=1, friends=0, history=50,
+                     payload_size=options.payload_size).start()
+    client = make_client(api)
+    channel = api.channel_ids[0]
+    client.harvest_identities([{'mentions': api.users}])
+    client.args.channel = channel
+    client.running = True
+    client.print_messages(client.window_messages())
+
+    tracemalloc.start()
+    warm = None
+    for cycle in range(options.cycles):
+        api.post(channel, 20)
+        client.print_messages(client.poll_messages(channel))
+        client.console.file = io.StringIO()
+        # The stand-in keeps every message, the client must not
+        with api.lock:
+            del api.messages[channel][:-100]
+        # Once the bounded caches (store, render memo) are full
+        # Cyclic garbage would make both readings depend on when the collector ran
+        if cycle == options.cycles // 2:
+            gc.collect()
+            warm = tracemalloc.get_traced_memory()[0]
+    gc.collect()
+    end = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    client.clean()
+    api.stop()
+
+    return {'memory_growth': ((end - warm) / 1024, 'KiB')}
+
+
+def bench_session(options):
+    """
+    Python heap growth over a long session: the current channel moves between
+    many channels, and every poll brings messages from users never seen before.
+    The growth is measured over `cycles / 2` polls, once every bounded cache
+    (stores, identities, render memo) is full.
+    """
+
+    from src.model import shared
+
+    # The table of interned strings belongs to the interpreter and is resized in
+    # steps as users come and go, its first resize once traced isn't growth
+    code = shared.__code__
+    ignored = [tracemalloc.Filter(False, code.co_filename, line)
+               for line in {line for _, _, line in code.co_lines() if line}]
+
+    def heap():
+        gc.collect()
+        snapshot = tracemalloc.take_snapshot().filter_traces(ignored)
+        return sum(stat.size for stat in snapshot.statistics('filename'))
+
+    api = StandInAPI(guilds=3, channels_per_guild=10, friends=0, history=50,
+                     payload_size=options.payload_size).start()
+    client = make_client(api)
+    channels = api.channel_ids
+    client.running = True
+
+    def cycle(index):
+        channel = channels[index % len(channels)]
+        client.args.channel = channel
+        api.post(channel, 20, [api.user(1000 + index * 20 + author) for author in range(20)])
+        client.print_messages(client.poll_messages(channel))
+        client.console.file = io.StringIO()
+        with api.lock:
+            del api.messages[channel][:-100]
+
+    tracemalloc.start()
+    index = 0
+    while index < 2 * len(channels) or len(client.ids) < client.ids.capacity:
+        cycle(index)
+        index += 1
+    warm = heap()
+    for index in range(index, index + options.cycles // 2):
+        cycle(index)
+    end = heap()
+    tracemalloc.stop()
+
+    client.clean()
+    api.stop()
+
+    return {'session_memory_growth': ((end - warm) / 1024, 'KiB')}
+
+
+def bench_store(options):
+    """ Python heap taken by a full message store, per message """
+
+    from src.model import Message
+    from src.store import MessageStore
+
+    api = StandInAPI(guilds=1, channels_per_guild=1, friends=0, history=200,
+                     payload_size=options.payload_size)
+    page = json.dumps(api.messages[api.channel_ids[0]])
+    api.server.server_close()
+
+    gc.collect()
+    tracemalloc.start()
+    # Decoded while traced, like an answer of Discord
+    data = json.loads(page)
+    store = MessageStore(len(data))
+    store.merge([Message.from_json(message) for message in data])
+    del data
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return {'stored_message_bytes': (size / len(store.values()), 'B')}
+
+
+def compare(results, baselines, tolerance):
+    """
+    Print the results next to their baselines.
+
+    :return: the names of the metrics worse than their baseline by more than `tolerance`.
+    """
+
+    regressions = []
+    print(f'{"metric":<28}{"value":>14}{"baseline":>14}{"change":>10}')
+    for name, (value, unit) in results.items():
+        baseline = baselines.get(name)
+        line = f'{name:<28}{value:>10.2f} {unit:<3}'
+        if baseline is None:
+            print(line)
+            continue
+
+        higher_is_better = unit == 'msg/s'
+        change = (value - baseline['value']) / baseline['value'] if baseline['value'] else 0
+        worse = -change if higher_is_better else change
+        # Memory growth near zero is noise (dicts of the bounded caches are resized in
+        # steps), compare it in absolute terms: a leak of the polled messages is MiBs
+        if unit == 'KiB':
+            worse = (value - baseline['value']) / max(abs(baseline['value']), 1024)
+        flag = '  REGRESSION' if worse > tolerance else ''
+        print(f'{line}{baseline["value"]:>10.2f} {unit:<3}{change:>+9.0%}{flag}')
+        if flag:
+            regressions.append(name)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--latency', type=float, default=0.02, help='Simulated latency (seconds)')
+    parser.add_argument('--payload-size', type=int, default=200, help='Characters per message')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.1,
+                        help='Share of 429s in the throttled poll benchmark')
+    parser.add_argument('--polls', type=int, default=50, help='Polls of the poll benchmarks')
+    parser.add_argument('--messages', type=int, default=2000, help='Messages of the render benchmark')
+    parser.add_argument('--cycles', type=int, default=400, help='Polls of the memory benchmark (20 messages each)')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed regression (0.25 = 25%%)')
+    parser.add_argument('--update', action='store_true', help='Save the results as the new baselines')
+    options = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix='chubbcord-bench-')
+    os.environ['HOME'] = home
+
+    results = {}
+    results.update(bench_startup(options))
+    results.update(bench_poll(options))
+    results.update(bench_poll(options, options.rate_limit_ratio))
+    results.update(bench_send(options))
+    results.update(bench_render(options))
+    results.update(bench_memory(options))
+    results.update(bench_session(options))
+    results.update(bench_store(options))
+
+    try:
+        with open(BASELINES, 'r', encoding='utf-8') as f:
+            baselines = json.load(f)
+    except (OSError, ValueError):
+        baselines = {}
+
+    regressions = compare(results, baselines, options.tolerance)
+
+    if options.update:
+        with open(BASELINES, 'w', encoding='utf-8') as f:
+            json.dump({name: {'value': round(value, 2), 'unit': unit}
+                       for name, (value, unit) in results.items()}, f, indent=4)
+            f.write('\n')
+        print(f'Baselines saved to {BASELINES}')
+    elif regressions:
+        sys.exit(f'Regressed: {", ".join(regressions)}')
+
+
+if __name__ == '__main__':
+    main()
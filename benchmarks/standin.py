@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# standin.py - Local stand-in for the Discord REST endpoints chubbcord uses.
+# --------------------------------------------------
+# Built-in
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+DISCORD_EPOCH = 1420070400000
+USER_ID = '100000000000000001'
+
+
+class StandInAPI():
+    """
+    Discord REST API served from memory on 127.0.0.1, with simulated latency,
+    payload sizes and rate limits (429).
+
+    Only the endpoints chubbcord calls are implemented: /users/@me, its DM channels
+    and guilds, guild channels, channel messages (latest, after= and before=
+    pages), message sends, attachment upload links and uploads, and the username
+    lookup service (under /lookup).
+    """
+
+    def __init__(self, latency=0.0, payload_size=64, rate_limit_ratio=0.0,
+                 guilds=10, channels_per_guild=10, friends=20, history=500, seed=0):
+        """
+        :param latency: Seconds every answer is delayed by.
+        :param payload_size: Characters in the content of generated messages.
+        :param rate_limit_ratio: Share (0-1) of the requests answered by a 429.
+        :param guilds: Number of guilds of the user.
+        :param channels_per_guild: Text channels per guild.
+        :param friends: Number of DM channels.
+        :param history: Messages already posted in every channel.
+        :param seed: Seed of the generated data and of the simulated 429s.
+        """
+
+        self.latency = latency
+        self.payload_size = payload_size
+        self.rate_limit_ratio = rate_limit_ratio
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        self.requests = {}
+        self.rate_limited = 0
+        self.uploads = {}
+        self.next_id = (int(time.time() * 1000) - DISCORD_EPOCH) << 22
+
+        self.users = [self.user(index) for index in range(50)]
+        self.friends = [
+            {'id': self.snowflake(), 'type': 1, 'recipients': [self.users[index % 50]]}
+            for index in range(friends)
+        ]
+        self.guilds = [
+            {'id': self.snowflake(), 'name': f'guild {index}', 'owner': index == 0}
+            for index in range(guilds)
+        ]
+        self.channels = {
+            guild['id']: [
+                {'id': self.snowflake(), 'type': 0, 'name': f'channel-{index}', 'guild_id': guild['id']}
+                for index in range(channels_per_guild)
+            ]
+            for guild in self.guilds
+        }
+        self.messages = {}
+
+        channel_ids = [friend['id'] for friend in self.friends] + [
+            channel['id'] for channels in self.channels.values() for channel in channels]
+        for channel_id in channel_ids:
+            self.messages[channel_id] = []
+            self.post(channel_id, history)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        port = self.server.server_address[1]
+        self.base_url = f'http://127.0.0.1:{port}/api/v9'
+        self.lookup_url = f'http://127.0.0.1:{port}/lookup'
+
+    @property
+    def channel_ids(self):
+        """ IDs of the guild text channels """
+
+        return [channel['id'] for channels in self.channels.values() for channel in channels]
+
+    def snowflake(self):
+        self.next_id += 1 << 12
+        return str(self.next_id)
+
+    def user(self, index):
+        """ :return: a user object, with the profile fields Discord sends along """
+
+        return {
+            'id': str(200000000000000000 + index),
+            'username': f'user{index}',
+            'global_name': None,
+            'avatar': f'{self.random.getrandbits(128):032x}',
+            'discriminator': '0',
+            'public_flags': 0,
+            'flags': 0,
+            'banner': None,
+            'accent_color': None,
+            'avatar_decoration_data': None,
+            'banner_color': None,
+            'clan': None,
+        }
+
+    def message(self, channel_id, author=None, content=None):
+        """
+        :return: a new message object, mentioning a user now and then, with every
+        field Discord sends (most of them unused by chubbcord).
+        """
+
+        author = author or self.random.choice(self.users)
+        if content is None:
+            mentioned = self.random.choice(self.users)
+            content = f'<@{mentioned["id"]}> ' if self.random.random() < 0.2 else ''
+            content += ''.join(self.random.choices('abcdefghij klmnop', k=self.payload_size))
+        mentions = [user for user in self.users if f'<@{user["id"]}>' in content]
+
+        return {
+            'id': self.snowflake(),
+            'type': 0,
+            'channel_id': channel_id,
+            'author': dict(author),
+            'content': content,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S.000000+00:00', time.gmtime()),
+            'edited_timestamp': None,
+            'tts': False,
+            'mention_everyone': False,
+            'mentions': mentions,
+            'mention_roles': [],
+            'attachments': [],
+            'embeds': [],
+            'pinned': False,
+            'flags': 0,
+            'components': [],
+        }
+
+    def post(self, channel_id, count=1, authors=None):
+        """
+        Post `count` new messages in a channel
+
+        :param authors: Users the messages are posted by, in turn, random known users if None.
+        """
+
+        with self.lock:
+            self.messages[channel_id] += [
+                self.message(channel_id, authors[index % len(authors)] if authors else None)
+                for index in range(count)
+            ]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def route(self, method, path, query, body):
+        """
+        :return: the (status, JSON payload) answering a request.
+        """
+
+        if path.startswith('/lookup/'):
+            user_id = path.rsplit('/', 1)[1]
+            user = next((user for user in self.users if user['id'] == user_id), None)
+            return (200, {'id': user_id, 'username': user['username']}) if user else (404, {})
+
+        path = path[len('/api/v9'):]
+        if path == '/users/@me':
+            return 200, {'id': USER_ID, 'username': 'benchmark'}
+        if path == '/users/@me/channels':
+            return 200, self.friends
+        if path == '/users/@me/guilds':
+            return 200, self.guilds
+
+        match = re.fullmatch(r'/guilds/(\d+)/channels', path)
+        if match:
+            return 200, self.channels.get(match.group(1), [])
+
+        match = re.fullmatch(r'/channels/(\d+)/messages', path)
+        if match and method == 'GET':
+            return 200, self.page(match.group(1), query)
+        if match and method == 'POST':
+            with self.lock:
+                messages = self.messages.setdefault(match.group(1), [])
+                # A nonce sent again answers with the message already posted
+                if body.get('enforce_nonce'):
+                    for message in messages:
+                        if message.get('nonce') == body.get('nonce'):
+                            return 200, message
+                message = self.message(match.group(1), {'id': USER_ID, 'username': 'benchmark'},
+                                       body.get('content', ''))
+                if body.get('nonce'):
+                    message['nonce'] = body['nonce']
+                messages.append(message)
+            return 200, message
+
+        match = re.fullmatch(r'/channels/(\d+)/attachments', path)
+        if match:
+            port = self.server.server_address[1]
+            return 200, {'attachments': [
+                {'id': file['id'], 'upload_url': f'http://127.0.0.1:{port}/upload/{self.snowflake()}',
+                 'upload_filename': f'uploads/{file["filename"]}'}
+                for file in body.get('files', [])
+            ]}
+
+        return 404, {'message': '404: Not Found', 'code': 0}
+
+    def page(self, channel_id, query):
+        """ :return: a page of messages, newest first, like Discord. """
+
+        limit = int(query.get('limit', ['50'])[0])
+        with self.lock:
+            # Like Discord, fetched messages come without their nonce
+            messages = [
+                {key: value for key, value in message.items() if key != 'nonce'}
+                if 'nonce' in message else message
+                for message in self.messages.get(channel_id, [])
+            ]
+
+        if 'after' in query:
+            after = int(query['after'][0])
+            return [message for message in messages if int(message['id']) > after][:limit][::-1]
+        if 'before' in query:
+            before = int(query['before'][0])
+            messages = [message for message in messages if int(message['id']) < before]
+
+        return messages[-limit:][::-1]
+
+    def upload(self, path, headers, body):
+        """ :return: the (status, headers) answering a chunk of a resumable upload. """
+
+        received = self.uploads.get(path, 0)
+        content_range = headers.get('Content-Range', '')
+        match = re.fullmatch(r'bytes (\d+)-(\d+)/(\d+)', content_range)
+        if match:
+            start, end, size = map(int, match.groups())
+            if start == received:
+                received = self.uploads[path] = end + 1
+        else:
+            size = int(content_range.rsplit('/', 1)[-1]) if '/' in content_range else len(body)
+            if not content_range:
+                received = self.uploads[path] = len(body)
+
+        if received >= size:
+            return 200, {}
+        return 308, {'Range': f'bytes=0-{received - 1}'} if received else {}
+
+    def handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, don't let Nagle delay the body
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def answer(self, status, payload=None, headers=None):
+                data = json.dumps(payload).encode() if payload is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def handle_request(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                parts = urlsplit(self.path)
+                route = re.sub(r'\d{15,}', '{id}', parts.path)
+
+                with api.lock:
+                    api.requests[(method, route)] = api.requests.get((method, route), 0) + 1
+                    throttled = api.random.random() < api.rate_limit_ratio
+                    if throttled:
+                        api.rate_limited += 1
+
+                if api.latency:
+                    time.sleep(api.latency)
+
+                if throttled:
+                    self.answer(429, {'message': 'You are being rate limited.', 'retry_after': 0.05,
+                                      'global': False},
+                                {'Retry-After': '0.05', 'X-RateLimit-Bucket': route,
+                                 'X-RateLimit-Limit': '5', 'X-RateLimit-Remaining': '0',
+                                 'X-RateLimit-Reset-After': '0.05', 'X-RateLimit-Scope': 'user'})
+                    return
+
+                if parts.path.startswith('/upload/'):
+                    status, headers = api.upload(parts.path, self.headers, body)
+                    self.answer(status, {} if status == 200 else None, headers)
+                    return
+
+                status, payload = api.route(
+                    method, parts.path, parse_qs(parts.query), json.loads(body) if body else {})
+                self.answer(status, payload, {
+                    'X-RateLimit-Bucket': route, 'X-RateLimit-Limit': '50',
+                    'X-RateLimit-Remaining': '49', 'X-RateLimit-Reset-After': '1',
+                })
+
+            def do_GET(self):
+                self.handle_request('GET')
+
+            def do_POST(self):
+                self.handle_request('POST')
+
+            def do_PUT(self):
+                self.handle_request('PUT')
+
+        return Handler
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# startup.py - One chubbcord launch, timed by run.py in a new interpreter.
+# --------------------------------------------------
+"""
+Start chubbcord against the stand-in API, print the welcome screen, then list
+the directory. The time (epoch) both were done at is written to stdout as JSON:
+
+    python benchmarks/startup.py <stand-in API URL> <stand-in lookup URL>
+
+Only chubbcord is imported here (not the stand-in), as in a real launch.
+"""
+# Built-in
+import io
+import json
+import os
+import sys
+import time
+
+
+def main():
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    stdout, sys.stdout = sys.stdout, io.StringIO()
+
+    from concurrent.futures import wait
+    from src import main
+
+    main.API_URL, main.LOOKUP_URL = sys.argv[1:3]
+    sys.argv = ['chubbcord', '-t', 'benchmark-token']
+    client = main.MyClient()
+    client.print_welcome()
+    welcome = time.time()
+
+    client.list_friends()
+    client.rprint_friends()
+    wait(client.list_guilds())
+    client.rprint_guilds()
+    ready = time.time()
+
+    client.clean()
+    stdout.write(json.dumps({'welcome': welcome, 'ready': ready}))
+
+
+if __name__ == '__main__':
+    main()
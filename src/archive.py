@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# archive.py - Messages persisted in SQLite, for scrollback across runs.
+# --------------------------------------------------
+# Built-in
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+from .model import Message
+
+SCHEMA_VERSION = 2
+# Milliseconds between the Unix epoch and the first second of 2015 (snowflakes)
+DISCORD_EPOCH = 1420070400000
+# Writes between two enforcements of the retention of a channel
+RETAIN_EVERY = 50
+
+
+def page_span(messages, limit, after=None, before=None):
+    """
+    Work out the range of IDs a page of messages covers without gaps.
+
+    :param messages: The page, oldest first.
+    :param limit: The `limit` the page was requested with.
+    :param after: The `after` cursor of the request.
+    :param before: The `before` cursor of the request.
+    :return: the (lowest, highest) IDs of the range, None if it is empty. A short
+    page without `after` reaches the beginning of the channel (lowest 0).
+    """
+
+    if after is not None:
+        return (int(after), int(messages[-1].id)) if messages else None
+
+    lowest = 0 if len(messages) < limit else int(messages[0].id)
+    if before is not None:
+        return (lowest, int(before))
+
+    return (lowest, int(messages[-1].id)) if messages else None
+
+
+def date_snowflake(date):
+    """
+    :param date: A date, as YYYY-MM-DD (local time).
+    :return: the lowest message ID posted on that day.
+    """
+
+    milliseconds = int(datetime.strptime(date, '%Y-%m-%d').timestamp() * 1000)
+    return max(milliseconds - DISCORD_EPOCH, 0) << 22
+
+
+def parse_search(query):
+    """
+    Split a search into its words and its filters.
+
+    :param query: Words, and filters: in:<channel>, from:<author>, after:<YYYY-MM-DD>,
+    before:<YYYY-MM-DD> (ex: "deploy fail* from:bob after:2024-03-01").
+    :return: the list of words and the dict of filters.
+    """
+
+    words = []
+    filters = {}
+    for token in query.split():
+        name, _, value = token.partition(':')
+        if value and name in ('in', 'from', 'after', 'before'):
+            filters[name] = value
+        else:
+            words.append(token)
+
+    return words, filters
+
+
+def author_name(message):
+    """ :return: the names a message can be searched by, with from:. """
+
+    return ' '.join(name for name in (message.username, message.global_name) if name)
+
+
+class MessageArchive():
+    """
+    The messages of every channel, persisted in a SQLite database.
+
+    The archive also records the ranges of IDs it holds without gaps, so older
+    messages already fetched are served without a request. Only the
+    `channel_limit` newest messages of a channel, and the `total_limit` newest
+    messages of all channels, are kept.
+    """
+
+    def __init__(self, path, channel_limit=20000, total_limit=200000):
+        """
+        :param path: SQLite database file.
+        :param channel_limit: Maximum number of messages kept per channel.
+        :param total_limit: Maximum number of messages kept in the whole archive.
+        """
+
+        self.path = path
+        self.channel_limit = channel_limit
+        self.total_limit = total_limit
+        self.lock = threading.Lock()
+        # Writes since the last enforcement of the retention, per channel and in all
+        self.writes = {}
+        self.total_writes = 0
+
+        # Shared by the UI, the scheduler and the gateway threads, behind `lock`
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.migrate()
+
+    def migrate(self):
+        """ Create the tables, dropping the ones of an outdated schema """
+
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version not in range(SCHEMA_VERSION + 1):
+            version = 0
+
+        with self.db:
+            if version < 1:
+                self.db.executescript('''
+                    DROP TABLE IF EXISTS messages;
+                    DROP TABLE IF EXISTS spans;
+                    CREATE TABLE messages (
+                        id INTEGER PRIMARY KEY,
+                        channel_id INTEGER NOT NULL,
+                        data TEXT NOT NULL
+                    );
+                    CREATE INDEX messages_channel ON messages (channel_id, id);
+                    CREATE TABLE spans (
+                        channel_id INTEGER NOT NULL,
+                        lowest INTEGER NOT NULL,
+                        highest INTEGER NOT NULL
+                    );
+                    CREATE INDEX spans_channel ON spans (channel_id);
+                ''')
+            if version < 2:
+                # Searchable text, taken out of the JSON of the archived messages
+                self.db.executescript('''
+                    ALTER TABLE messages ADD COLUMN content TEXT NOT NULL DEFAULT '';
+                    ALTER TABLE messages ADD COLUMN author TEXT NOT NULL DEFAULT '';
+                    UPDATE messages SET
+                        content = coalesce(json_extract(data, '$.content'), ''),
+                        author = trim(
+                            coalesce(json_extract(data, '$.author.username'), '') || ' ' ||
+                            coalesce(json_extract(data, '$.author.global_name'), '')
+                        );
+                ''')
+            self.db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+        self.searchable = self.create_index()
+
+    def create_index(self):
+        """
+        Create the full-text index of the messages, kept up to date by triggers.
+
+        :return: False if this SQLite has no FTS5 (search is unavailable).
+        """
+
+        exists = self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+        try:
+            with self.db:
+                self.db.executescript('''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                        content, author, content='messages', content_rowid='id'
+                    );
+                    CREATE TRIGGER IF NOT EXISTS messages_insert AFTER INSERT ON messages BEGIN
+                        INSERT INTO messages_fts (rowid, content, author)
+                        VALUES (new.id, new.content, new.author);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS messages_delete AFTER DELETE ON messages BEGIN
+                        INSERT INTO messages_fts (messages_fts, rowid, content, author)
+                        VALUES ('delete', old.id, old.content, old.author);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS messages_update AFTER UPDATE ON messages BEGIN
+                        INSERT INTO messages_fts (messages_fts, rowid, content, author)
+                        VALUES ('delete', old.id, old.content, old.author);
+                        INSERT INTO messages_fts (rowid, content, author)
+                        VALUES (new.id, new.content, new.author);
+                    END;
+                ''')
+                if not exists:
+                    self.db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        except sqlite3.OperationalError:
+            return False
+
+        return True
+
+    def store(self, channel, messages, span=None):
+        """
+        Save messages (new or edited) of a channel.
+
+        :param channel: Channel ID.
+        :param messages: List of `Message`.
+        :param span: (lowest, highest) IDs the messages cover without gaps, see
+        `page_span`.
+        """
+
+        with self.lock, self.db:
+            # Upserts, so the full-text index only sees messages that changed
+            self.db.executemany(
+                'INSERT INTO messages (id, channel_id, data, content, author)'
+                ' VALUES (?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET'
+                ' data = excluded.data, content = excluded.content, author = excluded.author'
+                ' WHERE data != excluded.data',
+                [(int(message.id), int(channel), json.dumps(message.to_json()),
+                  message.content, author_name(message)) for message in messages]
+            )
+            if span is not None:
+                self.add_span(int(channel), *span)
+            # Retention is enforced now and then, not on every poll
+            channel = int(channel)
+            self.writes[channel] = self.writes.get(channel, 0) + 1
+            if self.writes[channel] >= RETAIN_EVERY:
+                self.writes[channel] = 0
+                self.retain(channel)
+            self.total_writes += 1
+            if self.total_writes >= RETAIN_EVERY:
+                self.total_writes = 0
+                self.retain_total()
+
+    def delete(self, channel, message_ids):
+        """ Forget deleted messages of a channel """
+
+        with self.lock, self.db:
+            self.db.executemany(
+                'DELETE FROM messages WHERE id = ? AND channel_id = ?',
+                [(int(message_id), int(channel)) for message_id in message_ids]
+            )
+
+    def add_span(self, channel, lowest, highest):
+        """ Record a range of IDs held without gaps, merged with the ones it overlaps """
+
+        overlapping = self.db.execute(
+            'SELECT rowid, lowest, highest FROM spans'
+            ' WHERE channel_id = ? AND lowest <= ? AND highest >= ?',
+            (channel, highest, lowest)
+        ).fetchall()
+
+        for rowid, span_lowest, span_highest in overlapping:
+            lowest = min(lowest, span_lowest)
+            highest = max(highest, span_highest)
+            self.db.execute('DELETE FROM spans WHERE rowid = ?', (rowid,))
+
+        self.db.execute(
+            'INSERT INTO spans (channel_id, lowest, highest) VALUES (?, ?, ?)',
+            (channel, lowest, highest)
+        )
+
+    def retain(self, channel):
+        """ Drop the oldest messages of a channel beyond `channel_limit` """
+
+        cutoff = self.db.execute(
+            'SELECT id FROM messages WHERE channel_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?',
+            (channel, self.channel_limit)
+        ).fetchone()
+        if cutoff is None:
+            return
+
+        cutoff = cutoff[0]
+        self.db.execute('DELETE FROM messages WHERE channel_id = ? AND id <= ?', (channel, cutoff))
+        self.db.execute('DELETE FROM spans WHERE channel_id = ? AND highest <= ?', (channel, cutoff))
+        self.db.execute(
+            'UPDATE spans SET lowest = ? WHERE channel_id = ? AND lowest <= ?',
+            (cutoff + 1, channel, cutoff)
+        )
+
+    def retain_total(self):
+        """ Drop the oldest messages of all channels beyond `total_limit` """
+
+        cutoff = self.db.execute(
+            'SELECT id FROM messages ORDER BY id DESC LIMIT 1 OFFSET ?', (self.total_limit,)
+        ).fetchone()
+        if cutoff is None:
+            return
+
+        # Snowflakes are ordered by time in every channel
+        cutoff = cutoff[0]
+        self.db.execute('DELETE FROM messages WHERE id <= ?', (cutoff,))
+        self.db.execute('DELETE FROM spans WHERE highest <= ?', (cutoff,))
+        self.db.execute('UPDATE spans SET lowest = ? WHERE lowest <= ?', (cutoff + 1, cutoff))
+
+    def latest(self, channel, limit):
+        """
+        :param channel: Channel ID.
+        :param limit: Maximum number of messages.
+        :return: the newest archived messages of a channel, oldest first.
+        """
+
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT data FROM messages WHERE channel_id = ? ORDER BY id DESC LIMIT ?',
+                (int(channel), limit)
+            ).fetchall()
+
+        return [Message.from_json(json.loads(data)) for data, in reversed(rows)]
+
+    def history(self, channel, before, limit):
+        """
+        Serve the messages before a given one, if the archive holds them all.
+
+        :param channel: Channel ID.
+        :param before: Only messages older than this message ID.
+        :param limit: Number of messages wanted.
+        :return: up to `limit` messages, oldest first, or None if some of them may be
+        missing from the archive (they must be fetched).
+        """
+
+        before = int(before)
+        with self.lock:
+            span = self.db.execute(
+                'SELECT lowest FROM spans WHERE channel_id = ? AND lowest < ? AND highest >= ?',
+                (int(channel), before, before - 1)
+            ).fetchone()
+            if span is None:
+                return None
+
+            rows = self.db.execute(
+                'SELECT data FROM messages WHERE channel_id = ? AND id >= ? AND id < ?'
+                ' ORDER BY id DESC LIMIT ?',
+                (int(channel), span[0], before, limit)
+            ).fetchall()
+
+        # Fewer messages than wanted is only complete at the beginning of the channel
+        if len(rows) < limit and span[0] != 0:
+            return None
+
+        return [Message.from_json(json.loads(data)) for data, in reversed(rows)]
+
+    def search(self, words, channel=None, author=None, after=None, before=None, limit=25):
+        """
+        Search the archived messages.
+
+        :param words: Words the messages must contain, a word ending with * matches
+        every word starting with it.
+        :param channel: Only messages of this channel ID.
+        :param author: Only messages of authors with this name (or prefix, ending with *).
+        :param after: Only messages posted on or after this date (YYYY-MM-DD).
+        :param before: Only messages posted before this date (YYYY-MM-DD).
+        :param limit: Maximum number of results.
+        :return: the matching messages, newest first.
+        """
+
+        def phrase(text):
+            # Quoted, so punctuation in the words isn't read as FTS5 syntax. Prefix
+            # matches are on demand only, they are much slower on a large archive
+            prefix = '*' if text.endswith('*') and text.strip('*') else ''
+            text = text.strip('*') or text
+            return '"' + text.replace('"', '""') + '"' + prefix
+
+        match = [phrase(word) for word in words]
+        if author:
+            match.append(f'author : {phrase(author)}')
+
+        # IDs are snowflakes: newest first and date ranges are both ID order
+        key = 'messages_fts.rowid' if match else 'messages.id'
+        conditions = []
+        parameters = []
+        if channel is not None:
+            conditions.append('messages.channel_id = ?')
+            parameters.append(int(channel))
+        if after:
+            conditions.append(f'{key} >= ?')
+            parameters.append(date_snowflake(after))
+        if before:
+            conditions.append(f'{key} < ?')
+            parameters.append(date_snowflake(before))
+
+        if match:
+            # CROSS JOIN keeps the index outer: matches are walked newest first and
+            # the walk stops after `limit` results
+            query = ('SELECT messages.data FROM messages_fts'
+                     ' CROSS JOIN messages ON messages.id = messages_fts.rowid'
+                     ' WHERE messages_fts MATCH ?')
+            parameters.insert(0, ' '.join(match))
+        else:
+            query = 'SELECT messages.data FROM messages WHERE 1'
+        for condition in conditions:
+            query += f' AND {condition}'
+        query += f' ORDER BY {key} DESC LIMIT ?'
+        parameters.append(limit)
+
+        with self.lock:
+            rows = self.db.execute(query, parameters).fetchall()
+
+        return [Message.from_json(json.loads(data)) for data, in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# attachments.py - Background download cache for message attachments.
+# --------------------------------------------------
+# Built-in
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from .files import write_atomic
+from .model import Attachment
+from .ratelimit import BACKGROUND
+from .transport import TransportError
+
+INDEX_VERSION = 1
+CHUNK_SIZE = 64 * 1024
+
+# Largest side (pixels) of the variants fetched for previews, plenty for 80x25 cells
+PREVIEW_MAX_SIZE = 320
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp')
+VIDEO_EXTENSIONS = ('.mp4', '.webm', '.mov', '.mkv')
+
+
+def preview_variant(attachment, max_size=PREVIEW_MAX_SIZE):
+    """
+    Describe a size-bounded variant of an attachment, served resized by the Discord
+    media proxy, to preview it without downloading the original. Videos are
+    previewed by a poster frame.
+
+    :param attachment: `Attachment` of a message.
+    :param max_size: Largest side (pixels) of the variant.
+    :return: an `Attachment` of the variant, None if it can't be previewed.
+    """
+
+    content_type = attachment.content_type or ''
+    extension = os.path.splitext(attachment.filename)[1].lower()
+    is_video = content_type.startswith('video/') or extension in VIDEO_EXTENSIONS
+    is_image = content_type.startswith('image/') or extension in IMAGE_EXTENSIONS
+    width, height = attachment.width, attachment.height
+
+    if not (is_image or is_video) or not width or not height or not attachment.proxy_url:
+        return None
+
+    scale = min(1, max_size / width, max_size / height)
+    query = {
+        'width': max(1, round(width * scale)),
+        'height': max(1, round(height * scale)),
+    }
+    if is_video:
+        query['format'] = 'jpeg'
+        extension = '.jpg'
+
+    parts = urlsplit(attachment.proxy_url)
+    url = urlunsplit(parts._replace(query=urlencode(parse_qsl(parts.query) + list(query.items()))))
+
+    return Attachment(
+        id=f'{attachment.id}-{query["width"]}x{query["height"]}',
+        filename=os.path.splitext(attachment.filename)[0] + extension,
+        url=url
+    )
+
+
+class AttachmentCache():
+    """
+    Attachments downloaded by a pool of workers, streamed to disk in chunks.
+
+    Files are stored under the SHA-256 of their content, so two attachments with
+    the same name never overwrite each other, and the least recently used files
+    are evicted once the cache grows past its quota. The index of attachment IDs
+    keeps `capacity` entries at most, the least recently used are forgotten.
+    """
+
+    def __init__(self, http, directory, quota=500 * 1024 * 1024, workers=4, capacity=10000):
+        """
+        :param http: The `Transport` used to download attachments.
+        :param directory: Directory of the cache.
+        :param quota: Maximum size (bytes) of the cache.
+        :param workers: Attachments downloaded at the same time.
+        :param capacity: Attachment IDs kept in the index.
+        """
+
+        self.http = http
+        self.directory = directory
+        self.quota = quota
+        self.capacity = capacity
+        self.index_path = os.path.join(directory, 'index.json')
+
+        self.files = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def load(self):
+        """ Load the attachment ID -> file index, dropping entries whose file is gone """
+
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if isinstance(data, dict) and data.get('version') == INDEX_VERSION:
+            self.files = OrderedDict(
+                (attachment_id, filename) for attachment_id, filename in data['files'].items()
+                if os.path.exists(os.path.join(self.directory, filename))
+            )
+            while len(self.files) > self.capacity:
+                self.files.popitem(last=False)
+
+    def save(self):
+        """ Write the index to disk """
+
+        with self.lock:
+            data = {'version': INDEX_VERSION, 'files': dict(self.files)}
+
+        write_atomic(self.index_path, json.dumps(data))
+
+    def path(self, attachment):
+        """
+        :param attachment: `Attachment` of a message.
+        :return: the path of the downloaded attachment, None if not downloaded yet.
+        """
+
+        with self.lock:
+            filename = self.files.get(attachment.id)
+            if filename is None:
+                return None
+            self.files.move_to_end(attachment.id)
+
+        path = os.path.join(self.directory, filename)
+        try:
+            # The modification time is the LRU clock of the evictor
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.files.pop(attachment.id, None)
+            return None
+
+        return path
+
+    def fetch(self, attachment, on_done=None):
+        """
+        Download an attachment in the background, once.
+
+        :param attachment: `Attachment` of a message.
+        :param on_done: Called with the attachment and its path once downloaded
+        (right away if it already is).
+        """
+
+        path = self.path(attachment)
+        if path is not None:
+            if on_done:
+                on_done(attachment, path)
+            return
+
+        with self.lock:
+            callbacks = self.pending.get(attachment.id)
+            if callbacks is not None:
+                if on_done:
+                    callbacks.append(on_done)
+                return
+            self.pending[attachment.id] = [on_done] if on_done else []
+
+        self.pool.submit(self.download, attachment)
+
+    def download(self, attachment):
+        """ Worker streaming an attachment to disk, then calling its callbacks """
+
+        path = None
+        try:
+            path = self.stream(attachment)
+        except (TransportError, OSError):
+            pass
+        finally:
+            with self.lock:
+                callbacks = self.pending.pop(attachment.id, [])
+
+        if path is None:
+            return
+        self.evict()
+        for callback in callbacks:
+            callback(attachment, path)
+
+    def stream(self, attachment):
+        """
+        Stream an attachment to a temporary file while hashing it, then move it to
+        its content-addressed path.
+
+        :return: the path of the downloaded attachment.
+        """
+
+        response = self.http.get(
+            attachment.url,
+            stream=True,
+            priority=BACKGROUND,
+            action='Download attachment'
+        )
+
+        digest = hashlib.sha256()
+        tmp = os.path.join(self.directory, f'{attachment.id}.part')
+        try:
+            with open(tmp, 'wb') as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    digest.update(chunk)
+                    f.write(chunk)
+            extension = os.path.splitext(attachment.filename)[1].lower()
+            filename = digest.hexdigest() + extension
+            path = os.path.join(self.directory, filename)
+            os.replace(tmp, path)
+        finally:
+            response.close()
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        with self.lock:
+            self.files[attachment.id] = filename
+            while len(self.files) > self.capacity:
+                self.files.popitem(last=False)
+
+        return path
+
+    def evict(self):
+        """ Remove the least recently used files until the cache fits in its quota """
+
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(('.part', '.tmp', '.json')):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.name))
+
+        total = sum(size for _, size, _ in entries)
+        if total <= self.quota:
+            return
+
+        evicted = set()
+        for _, size, name in sorted(entries):
+            if total <= self.quota:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total -= size
+            evicted.add(name)
+
+        with self.lock:
+            self.files = OrderedDict(
+                (attachment_id, filename) for attachment_id, filename in self.files.items()
+                if filename not in evicted
+            )
+
+    def close(self):
+        """ Stop the workers, enforce the quota and save the index """
+
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.evict()
+        self.save()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# directory.py - On-disk snapshot of the guilds, channels and DM lists.
+# --------------------------------------------------
+# Built-in
+import json
+import threading
+import time
+
+from .files import write_atomic
+
+DIRECTORY_VERSION = 1
+
+
+class DirectorySnapshot():
+    """
+    Last known guilds, channels and DM channels, served at startup while the
+    real ones are fetched, along with the local channel IDs handed out so far.
+
+    A local ID, once given to a channel, is kept between runs and never reused.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: JSON file the snapshot is loaded from and saved to.
+        """
+
+        self.path = path
+        self.friends = None
+        self.guilds = None
+        self.saved_at = None
+        self.local_ids = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Load the snapshot, ignoring a missing, corrupt or outdated file.
+
+        :return: True if a snapshot was loaded.
+        """
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if not isinstance(data, dict) or data.get('version') != DIRECTORY_VERSION:
+            return False
+
+        self.friends = data['friends']
+        self.guilds = data['guilds']
+        self.saved_at = data['saved_at']
+        self.local_ids = data['local_ids']
+        self.next_id = max(self.local_ids.values(), default=0) + 1
+
+        return True
+
+    def save(self, friends, guilds):
+        """ Write the snapshot to disk
+
+        :param friends: DM channels.
+        :param guilds: Guilds, with their `channels`.
+        """
+
+        with self.lock:
+            data = {
+                'version': DIRECTORY_VERSION,
+                'saved_at': time.time(),
+                'friends': friends,
+                'guilds': guilds,
+                'local_ids': dict(self.local_ids),
+            }
+
+        write_atomic(self.path, json.dumps(data))
+
+    def local_id(self, channel_id):
+        """
+        :param channel_id: Discord ID of a channel.
+        :return: the local ID of the channel, handing out the next one if it has none.
+        """
+
+        with self.lock:
+            if channel_id not in self.local_ids:
+                self.local_ids[channel_id] = self.next_id
+                self.next_id += 1
+            return self.local_ids[channel_id]
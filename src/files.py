@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# files.py - Atomic writes of the on-disk caches.
+# --------------------------------------------------
+# Built-in
+import os
+
+
+def write_atomic(path, text):
+    """
+    Write a file atomically (temporary file, then rename), so a crash or another
+    instance never leaves it half written. Failures are ignored: the files written
+    this way are caches.
+
+    :param path: The file to replace.
+    :param text: Its new content.
+    """
+
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
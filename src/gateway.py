@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# gateway.py - Real-time events from the Discord gateway (WebSocket).
+# --------------------------------------------------
+# Built-in
+import json
+import random
+import threading
+from urllib.parse import urlsplit
+
+# 3rd party
+import websocket
+
+GATEWAY_URL = 'wss://gateway.discord.gg/?v=9&encoding=json'
+
+# GUILD_MESSAGES | DIRECT_MESSAGES | MESSAGE_CONTENT
+INTENTS = (1 << 9) | (1 << 12) | (1 << 15)
+
+# Close codes after which reconnecting is pointless (bad token, bad intents...)
+FATAL_CLOSE_CODES = (4004, 4010, 4011, 4012, 4013, 4014)
+# Close codes after which the session can't be resumed
+RESET_CLOSE_CODES = (4007, 4009)
+
+
+class Gateway():
+    """
+    A gateway session running in its own thread.
+
+    It handles the heartbeat, resumes the session after a reconnection, and hands
+    every dispatched event to `on_dispatch(event_name, data)`.
+    """
+
+    def __init__(self, token, on_dispatch, url=GATEWAY_URL, user_agent=None,
+                 on_error=None, on_disconnect=None):
+        """
+        :param token: Discord token.
+        :param on_dispatch: Callback called with the name and data of every event.
+        :param url: Gateway URL, overridable to talk to a local stand-in server.
+        :param user_agent: User-Agent sent with the WebSocket handshake.
+        :param on_error: Called with the event name and the exception when
+        `on_dispatch` raises (the session goes on).
+        :param on_disconnect: Called when a connected session drops.
+        """
+
+        self.token = token
+        self.on_dispatch = on_dispatch
+        self.url = url
+        self.user_agent = user_agent
+        self.on_error = on_error
+        self.on_disconnect = on_disconnect
+
+        self.session_id = None
+        self.sequence = None
+        self.resume_url = None
+
+        self.connected = False
+        self.backoff = 0
+        self.last_error = None
+
+        self.ws = None
+        self.thread = None
+        self.heartbeat_acked = True
+        self.stopped = threading.Event()
+
+    def start(self):
+        """ Start the gateway thread """
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Close the connection and wait for the gateway thread to end """
+
+        self.stopped.set()
+        if self.ws:
+            self.ws.abort()
+        if self.thread:
+            self.thread.join(timeout=5)
+
+    def run(self):
+        """ Connect, and reconnect with an exponential backoff until stopped """
+
+        while not self.stopped.is_set():
+            try:
+                self.connect()
+            except (websocket.WebSocketException, OSError, ValueError, KeyError) as error:
+                self.last_error = error
+            finally:
+                dropped = self.connected
+                self.connected = False
+                if self.ws:
+                    self.ws.abort()
+
+            if dropped and self.on_disconnect and not self.stopped.is_set():
+                self.on_disconnect()
+
+            if self.stopped.wait(self.backoff):
+                break
+            self.backoff = min(max(self.backoff * 2, 1), 60)
+
+    def connect(self):
+        """ Open a connection, identify or resume, then read events until it drops """
+
+        url = self.resume_url if self.session_id and self.resume_url else self.url
+        header = [f'User-Agent: {self.user_agent}'] if self.user_agent else None
+        self.ws = websocket.create_connection(url, timeout=10, header=header)
+
+        hello = self.receive()
+        if hello['op'] != 10:
+            raise ValueError(f'Expected HELLO, got op {hello["op"]}')
+
+        self.ws.settimeout(1)
+        self.heartbeat_acked = True
+        beating = threading.Event()
+        threading.Thread(
+            target=self.heartbeat,
+            args=(self.ws, hello['d']['heartbeat_interval'] / 1000, beating),
+            daemon=True
+        ).start()
+
+        try:
+            if self.session_id and self.sequence is not None:
+                self.send({'op': 6, 'd': {
+                    'token': self.token,
+                    'session_id': self.session_id,
+                    'seq': self.sequence,
+                }})
+            else:
+                self.send({'op': 2, 'd': {
+                    'token': self.token,
+                    'intents': INTENTS,
+                    'properties': {'os': 'linux', 'browser': 'chubbcord', 'device': 'chubbcord'},
+                }})
+
+            while not self.stopped.is_set():
+                try:
+                    payload = self.receive()
+                except websocket.WebSocketTimeoutException:
+                    continue
+                if not self.handle(payload):
+                    return
+        finally:
+            beating.set()
+
+    def handle(self, payload):
+        """
+        Handle a gateway payload.
+
+        :param payload: Decoded payload.
+        :return: False if the connection must be dropped and reopened.
+        """
+
+        op = payload['op']
+
+        if op == 0:
+            self.sequence = payload['s']
+            if payload['t'] == 'READY':
+                self.session_id = payload['d']['session_id']
+                query = urlsplit(self.url).query
+                self.resume_url = payload['d']['resume_gateway_url'].rstrip('/') + f'/?{query}'
+            if payload['t'] in ('READY', 'RESUMED'):
+                self.connected = True
+                self.backoff = 0
+            try:
+                self.on_dispatch(payload['t'], payload['d'])
+            except Exception as error:
+                # A rendering error must not drop the session
+                self.last_error = error
+                if self.on_error:
+                    self.on_error(payload['t'], error)
+        elif op == 1:
+            self.send({'op': 1, 'd': self.sequence})
+        elif op == 7:
+            return False
+        elif op == 9:
+            if not payload['d']:
+                self.session_id = None
+                self.sequence = None
+            self.backoff = 1 + random.random() * 4
+            return False
+        elif op == 11:
+            self.heartbeat_acked = True
+
+        return True
+
+    def heartbeat(self, ws, interval, stopped):
+        """
+        Send a heartbeat every `interval` seconds, and drop the connection if the last
+        one was never acknowledged (zombied connection).
+
+        :param ws: The connection to keep alive.
+        :param interval: Heartbeat interval (seconds) sent by HELLO.
+        :param stopped: Event set when the connection is closed.
+        """
+
+        wait = interval * random.random()
+        while not stopped.wait(wait):
+            if not self.heartbeat_acked:
+                ws.abort()
+                return
+            self.heartbeat_acked = False
+            try:
+                self.send({'op': 1, 'd': self.sequence}, ws)
+            except (websocket.WebSocketException, OSError):
+                return
+            wait = interval
+
+    def send(self, payload, ws=None):
+        """ Send a payload as JSON """
+
+        (ws or self.ws).send(json.dumps(payload))
+
+    def receive(self):
+        """
+        Receive the next payload.
+
+        :return: the decoded payload.
+        """
+
+        opcode, data = self.ws.recv_data()
+
+        if opcode == websocket.ABNF.OPCODE_CLOSE:
+            code = int.from_bytes(data[:2], 'big') if len(data) >= 2 else None
+            if code in FATAL_CLOSE_CODES:
+                self.stopped.set()
+            if code in RESET_CLOSE_CODES:
+                self.session_id = None
+                self.sequence = None
+            raise websocket.WebSocketConnectionClosedException(
+                f'Gateway closed the connection ({code})')
+
+        return json.loads(data)
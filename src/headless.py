@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# headless.py - JSONL message stream on stdout, bulk send from stdin.
+# --------------------------------------------------
+# Built-in
+import json
+import signal
+import sys
+import threading
+
+from .main import MENTION, MyClient
+from .transport import TransportError
+
+
+class HeadlessClient(MyClient):
+    """
+    chubbcord without its UI, as a pipeline component.
+
+    Messages of the channels given with -c and -w are written to stdout as JSON
+    lines, and the lines read from stdin are sent, paced by the rate limiter.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.output_lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def normalize(self, message, event):
+        """
+        :param message: The `Message`.
+        :param event: What happened to it: create, edit or delete.
+        :return: the message as a flat, stable dict, with mentions resolved.
+        """
+
+        referenced = message.referenced
+
+        return {
+            'event': event,
+            'id': message.id,
+            'channel_id': message.channel_id,
+            'channel': self.channel_names.get(message.channel_id),
+            'author_id': message.author_id,
+            'author': message.author_name,
+            'timestamp': message.timestamp,
+            'edited_timestamp': message.edited_timestamp,
+            'content': self.resolve_mentions(message.content),
+            'attachments': [
+                {'filename': attachment.filename, 'url': attachment.url,
+                 'size': attachment.size}
+                for attachment in message.attachments
+            ],
+            'reply_to': referenced.id if referenced is not None else None,
+        }
+
+    def resolve_mentions(self, content):
+        """
+        :param content: Content of a message.
+        :return: the content with user mentions replaced by @username, unknown users
+        are written by ID and looked up in the background for the next messages.
+        """
+
+        if '<@' not in content:
+            return content
+
+        def mention(match):
+            # Called under store_lock: no network here
+            user_id = match.group(1)
+            username = self.ids.get(user_id)
+            if username is None:
+                self.queue_lookup(user_id)
+                username = user_id
+            return f'@{username}'
+
+        return MENTION.sub(mention, content)
+
+    def print_messages(self, delta):
+        """ Write a `MessageDelta` to stdout, one JSON line per message """
+
+        records = (
+            [self.normalize(message, 'create') for message in delta.inserted] +
+            [self.normalize(message, 'edit') for message in delta.edited] +
+            [self.normalize(message, 'delete') for message in delta.deleted]
+        )
+        if not records:
+            return
+
+        with self.output_lock:
+            try:
+                sys.stdout.write(''.join(
+                    json.dumps(record, ensure_ascii=False) + '\n' for record in records))
+                sys.stdout.flush()
+            except BrokenPipeError:
+                # Nobody reads the stream anymore
+                self.stopped.set()
+
+    def print_entries(self, entries):
+        """ Previews, :up and resolved mentions are for the UI, there is no screen here """
+
+    def send_line(self, line):
+        """
+        Queue a line of stdin to be sent.
+
+        :param line: A message, or a JSON object {"channel_id": ..., "content": ...} to
+        send to another channel than -c.
+        """
+
+        channel = self.args.channel
+        content = line
+        if line.startswith('{'):
+            try:
+                data = json.loads(line)
+                channel = str(data.get('channel_id') or channel)
+                content = data['content']
+            except (ValueError, KeyError, AttributeError):
+                pass
+
+        if not content.strip():
+            return
+
+        # Sent back to stdout by the polls, like any other message
+        self.outbox.put(channel, content)
+
+    def warn(self, text):
+        """ Report problems on stderr, stdout only carries the messages """
+
+        print(f'chubbcord: {text}', file=sys.stderr, flush=True)
+
+    def on_message_failed(self, channel, nonce, content, error):
+        """ Report a line that couldn't be sent, even after retries """
+
+        self.warn(error)
+
+    def read_stdin(self):
+        """ Send every line of stdin, until it is closed """
+
+        for line in sys.stdin:
+            if self.stopped.is_set():
+                return
+            self.send_line(line.rstrip('\n'))
+
+        self.outbox.join()
+
+    def main(self):
+        """
+        The main function streams the channels until interrupted (or until stdout is
+        closed), while sending what comes on stdin.
+        """
+
+        channels = ([self.args.channel] if self.args.channel else []) + sorted(self.watched)
+        if not channels:
+            sys.exit('Headless mode needs channels to follow (-c and/or -w)')
+        if not self.args.channel:
+            self.args.channel = channels[0]
+
+        self.load_directory()
+        signal.signal(signal.SIGTERM, lambda *_: self.stopped.set())
+
+        if self.args.gateway:
+            self.start_gateway()
+
+        # Only what is posted from now on is streamed
+        self.running = True
+        for channel in channels:
+            self.watched.add(channel)
+            try:
+                self.reset_messages(channel)
+            except TransportError as error:
+                self.warn(error)
+            self.scheduler.watch(channel)
+        self.scheduler.start()
+
+        threading.Thread(target=self.read_stdin, daemon=True).start()
+
+        try:
+            self.stopped.wait()
+        except KeyboardInterrupt:
+            pass
+        self.clean()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# identity.py - Persistent user ID -> username cache.
+# --------------------------------------------------
+# Built-in
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from .files import write_atomic
+
+CACHE_VERSION = 1
+
+
+class IdentityCache():
+    """
+    User ID -> username map persisted as JSON, with a TTL on every entry and a
+    size bound enforced by evicting the least recently used entries.
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600, capacity=5000, autosave=25):
+        """
+        :param path: JSON file the cache is loaded from and saved to.
+        :param ttl: Seconds after which a username is looked up again.
+        :param capacity: Maximum number of users kept.
+        :param autosave: Save after this many new entries (0 to only save on demand).
+        """
+
+        self.path = path
+        self.ttl = ttl
+        self.capacity = capacity
+        self.autosave = autosave
+
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.unsaved = 0
+        # Bumped whenever a username is added or changes
+        self.version = 0
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        """ Load the cache from disk, ignoring a missing, corrupt or outdated file """
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if not isinstance(data, dict) or data.get('version') != CACHE_VERSION:
+            return
+
+        now = time.time()
+        with self.lock:
+            # Saved least recently used first
+            for user_id, (username, fetched_at) in data['users'].items():
+                if fetched_at + self.ttl > now:
+                    self.entries[user_id] = (username, fetched_at)
+            self.evict()
+
+    def save(self):
+        """ Write the cache to disk """
+
+        with self.lock:
+            data = {'version': CACHE_VERSION, 'users': dict(self.entries)}
+            self.unsaved = 0
+
+        write_atomic(self.path, json.dumps(data))
+
+    def get(self, user_id):
+        """
+        :return: the cached username of `user_id`, None if unknown or expired.
+        """
+
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+            if entry[1] + self.ttl <= time.time():
+                del self.entries[user_id]
+                return None
+            self.entries.move_to_end(user_id)
+            return entry[0]
+
+    def set(self, user_id, username):
+        """ Cache the username of `user_id` """
+
+        with self.lock:
+            known = self.entries.get(user_id)
+            self.entries[user_id] = (username, time.time())
+            self.entries.move_to_end(user_id)
+            self.evict()
+            if known is None or known[0] != username:
+                self.unsaved += 1
+                self.version += 1
+            save = self.autosave and self.unsaved >= self.autosave
+
+        if save:
+            self.save()
+
+    def evict(self):
+        """ Drop the least recently used entries beyond `capacity` """
+
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
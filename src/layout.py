@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# layout.py - Fixed width rows of the :li and :dm directory listings.
+# --------------------------------------------------
+# 3rd party
+from wcwidth import wcswidth, wcwidth
+
+ROW_WIDTH = 80
+
+
+def cell_width(text):
+    """
+    :param text: A plain string.
+    :return: the number of terminal cells the string takes (emoji and wide
+    characters take 2, combining characters 0).
+    """
+
+    width = wcswidth(text)
+    if width >= 0:
+        return width
+
+    # Control characters make wcswidth give up, count the printable ones only
+    return sum(max(wcwidth(char), 0) for char in text)
+
+
+def truncate(text, width):
+    """
+    :param text: A plain string.
+    :param width: Number of cells available.
+    :return: the string cut to fit in `width` cells, ending with '...' if it was cut.
+    """
+
+    if cell_width(text) <= width:
+        return text
+
+    width -= 3
+    cut = 0
+    used = 0
+    for char in text:
+        char_width = max(wcwidth(char), 0)
+        if used + char_width > width:
+            break
+        used += char_width
+        cut += 1
+
+    return text[:cut] + '...'
+
+
+class RowLayout():
+    """
+    Lay out rows of `ROW_WIDTH` cells, made of (text, style, shrinkable) parts.
+
+    Every row is rendered once and cached, so a listing only renders again the
+    entries that changed, and an unchanged listing is returned as is.
+    """
+
+    def __init__(self, width=ROW_WIDTH):
+        self.width = width
+        self.rows = {}
+        self.last = (None, None)
+
+    def row(self, parts):
+        """
+        :param parts: A tuple of (text, style, shrinkable) parts, `style` being a rich
+        style or None. Shrinkable parts are truncated when the row is too long.
+        :return: the rich formatted row, padded to `width` cells.
+        """
+
+        row = self.rows.get(parts)
+        if row is not None:
+            return row
+
+        # Imported here, like every rich import of chubbcord (see main.rprint)
+        from rich.markup import escape
+
+        widths = [cell_width(text) for text, _, _ in parts]
+        overflow = sum(widths) - (self.width - 1)
+
+        row = ''
+        used = 0
+        for (text, style, shrinkable), width in zip(parts, widths):
+            if shrinkable and overflow > 0:
+                text = truncate(text, max(width - overflow, 3))
+                overflow -= width - cell_width(text)
+                width = cell_width(text)
+            used += width
+            text = escape(text)
+            row += f'[{style}]{text}[/{style}]' if style else text
+
+        row += ' ' * max(self.width - used, 1) + '\n'
+
+        self.rows[parts] = row
+        return row
+
+    def render(self, rows):
+        """
+        :param rows: A list of rows, each a tuple of parts (see `row`).
+        :return: the rich formatted listing.
+        """
+
+        key = tuple(rows)
+        if key == self.last[0]:
+            return self.last[1]
+
+        content = ''.join(self.row(parts) for parts in rows)
+
+        # Forget the rows of entries that are gone
+        if len(self.rows) > 2 * len(rows):
+            self.rows = {parts: self.rows[parts] for parts in rows}
+
+        self.last = (key, content)
+        return content
@@ -10,24 +10,100 @@ import time
 import argparse
 import threading
 import sys
-import subprocess as sp
-
-# 3rd party
-from emoji import EMOJI_DATA
-import requests
-import fake_useragent
-
-from rich import print as rprint
-from rich.console import Console
-
-from prompt_toolkit import prompt
-from prompt_toolkit.patch_stdout import patch_stdout
-
 import re
+import shutil
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from .archive import MessageArchive, date_snowflake, page_span, parse_search
+from .attachments import AttachmentCache, preview_variant
+from .directory import DirectorySnapshot
+from .gateway import Gateway
+from .identity import IdentityCache
+from .layout import RowLayout
+from .metrics import RENDER_BUCKETS, Metrics, MetricsExporter
+from .model import DELETED, Message
+from .outbox import Outbox, new_nonce
+from .preview import PreviewRenderer
+from .ratelimit import BACKGROUND, INTERACTIVE
+from .scheduler import PollScheduler
+from .session import SessionSnapshot, random_user_agent
+from .store import MessageDelta, MessageStore
+from .transport import Transport, TransportError
+from .uploads import UploadProgress, upload_file
 
 homedir = os.path.expanduser('~')
 confdir = os.path.expanduser('~/.chubbcord')
 
+# Endpoints, overridable to run against a local stand-in (see benchmarks/)
+API_URL = os.environ.get('CHUBBCORD_API_URL', 'https://discord.com/api/v9')
+LOOKUP_URL = os.environ.get('CHUBBCORD_LOOKUP_URL', 'https://discordlookup.mesalytic.moe/v1/user')
+
+# Messages shown when opening a channel, and page size of incremental polls
+MESSAGES_WINDOW = 35
+# Messages kept in memory per channel, and in the archive on disk (per channel
+# and in all)
+STORE_LIMIT = 200
+ARCHIVE_LIMIT = 20000
+ARCHIVE_TOTAL_LIMIT = 200000
+# Channels whose messages are kept in memory, besides the current and watched ones
+STORE_CHANNELS = 16
+# Messages printed by :search:
+SEARCH_RESULTS = 25
+POLL_PAGE_SIZE = 100
+# Past this many pages between two ticks, the full window is fetched again
+POLL_MAX_PAGES = 5
+# Seconds between two polls of a channel right after activity, and at most once
+# idle (the interval doubles after every poll finding nothing new)
+POLL_FLOOR = 1
+POLL_CEILING = 30
+# Polls per second shared by all the watched channels
+POLL_BUDGET = 2
+# Guild channel lists fetched at the same time
+DIRECTORY_WORKERS = 4
+# Unknown users looked up at the same time, and users remembered as not found
+LOOKUP_WORKERS = 4
+FAILED_LOOKUPS_LIMIT = 1000
+# Files of an :attach: command uploaded at the same time, and seconds between
+# two progress reports
+UPLOAD_WORKERS = 3
+UPLOAD_REPORT_INTERVAL = 2
+# Times a message is sent again after a network or server error, and seconds
+# waited at exit for the messages not sent yet
+SEND_RETRIES = 4
+SEND_DRAIN_TIMEOUT = 5
+# Messages sent and printed right away, whose copy from Discord isn't printed again
+ECHOED_LIMIT = 100
+
+PENDING_TAG = ' [bright_black](pending)[/bright_black]'
+
+# Formatted messages kept in memory
+RENDER_MEMO_SIZE = 2000
+# Rendered lines kept per formatted message (with and without a tag...)
+RENDERED_LINES = 4
+
+# Seconds between two writes of the --metrics-file
+METRICS_INTERVAL = 15
+
+MENTION = re.compile(r'<@!?(\d{15,21})>')
+
+
+# rich and prompt_toolkit take longer to import than the rest of chubbcord, they are
+# imported on first use (the headless mode never uses prompt_toolkit, nor rich)
+def rprint(*objects, **kwargs):
+    from rich import print as rich_print
+    rich_print(*objects, **kwargs)
+
+
+def prompt(*args, **kwargs):
+    from prompt_toolkit import prompt as toolkit_prompt
+    return toolkit_prompt(*args, **kwargs)
+
+
+def patch_stdout(*args, **kwargs):
+    from prompt_toolkit.patch_stdout import patch_stdout as toolkit_patch_stdout
+    return toolkit_patch_stdout(*args, **kwargs)
+
 def parse_args():
     """
     The `parse_args` function is used to parse command line arguments for the user's email,
@@ -63,6 +139,51 @@ def parse_args():
         help='Custom user token',
         default=None
     )
+    parser.add_argument(
+        '-g', '--gateway',
+        help='Receive messages in real time (REST polling is only a fallback)',
+        action='store_true'
+    )
+    parser.add_argument(
+        '-w', '--watch',
+        help='Other channel IDs to follow, comma separated',
+        default=''
+    )
+    parser.add_argument(
+        '-s', '--split',
+        help='Print watched channels under a header instead of tagging every message',
+        action='store_true'
+    )
+    parser.add_argument(
+        '-H', '--headless',
+        help='Stream messages of -c/-w channels as JSON lines on stdout, and send the '
+             'lines of stdin (no UI)',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--poll-floor',
+        help='Seconds between two polls of an active channel',
+        type=float,
+        default=POLL_FLOOR
+    )
+    parser.add_argument(
+        '--poll-ceiling',
+        help='Seconds between two polls of an idle channel, at most',
+        type=float,
+        default=POLL_CEILING
+    )
+    parser.add_argument(
+        '--metrics-file',
+        help='Write the metrics (see :stats) to this file in the Prometheus text format '
+             '(ex: for the node exporter textfile collector)',
+        default=None
+    )
+    parser.add_argument(
+        '--metrics-interval',
+        help='Seconds between two writes of the metrics file',
+        type=float,
+        default=METRICS_INTERVAL
+    )
 
     return parser.parse_args()
 
@@ -70,12 +191,19 @@ def parse_args():
 class MyClient():
     def __init__(self) -> None:
         self.args = parse_args()
-        self.url = 'https://discord.com/api/v9'
+        self.url = API_URL
+        self.metrics = Metrics()
 
         if not os.path.exists(confdir):
             os.mkdir(confdir)
-        if not os.path.exists(confdir + '/tmp'):
-             os.mkdir(confdir + '/tmp')
+
+        # Same User-Agent from a run to the other, like a browser
+        self.session = SessionSnapshot(f'{confdir}/session.json')
+        self.session.load()
+        if self.session.user_agent is None:
+            self.session.user_agent = random_user_agent()
+            self.session.save()
+        self.http = Transport(self.url, self.session.user_agent, metrics=self.metrics)
 
         if not self.args.token:
             if os.path.exists(homedir + '/.chubbcord/user.token.json'):
@@ -93,17 +221,76 @@ class MyClient():
             else:
                 self.login()
 
-        self.headers = {
-            'User-Agent': fake_useragent.UserAgent().random,
-            'Authorization': self.args.token if self.args.token else self.token
-        }
+        self.http.token = self.args.token if self.args.token else self.token
 
+        self.ids = IdentityCache(f'{confdir}/users.json')
+        self.ids.load()
 
-        if self.args.token:
+        # Own profile (id, username, global_name), pending messages are shown with it
+        me = self.session.profile(self.http.token)
+        if me is not None:
+            # The profile of the last run, checked while the welcome screen shows
+            self.user_id = me['id']
+            self.me = me
+            self.ids.set(me['id'], me['username'])
+            threading.Thread(target=self.validate_session, daemon=True).start()
+        elif self.args.token:
             self.user_id = self.get_my_id()
-
-        self.ids = {}
-        self.attachments = []
+        else:
+            # Logged in with a password: only the ID is known until the profile is fetched
+            self.me = {'id': self.user_id, 'username': None, 'global_name': None}
+            threading.Thread(target=self.validate_session, daemon=True).start()
+
+        self.attachment_cache = AttachmentCache(self.http, f'{confdir}/attachments')
+        self.previews = PreviewRenderer(metrics=self.metrics)
+        self._console = None
+        self.render_memo = OrderedDict()
+        self.stores = OrderedDict()
+        self.store_lock = threading.RLock()
+        self.archive = MessageArchive(
+            f'{confdir}/messages.{self.user_id}.db', ARCHIVE_LIMIT, ARCHIVE_TOTAL_LIMIT)
+        self.scrollback = {}
+        self.gateway = None
+        self.running = False
+        self.watched = {channel.strip() for channel in self.args.watch.split(',') if channel.strip()}
+        self.channel_names = {}
+        self.last_printed_channel = None
+        self.scheduler = PollScheduler(
+            self.poll_channel,
+            floor=self.args.poll_floor,
+            ceiling=self.args.poll_ceiling,
+            budget=POLL_BUDGET,
+            metrics=self.metrics,
+            on_error=self.on_poll_error
+        )
+        self.friends = []
+        self.guilds = []
+        self.list_id = {}
+        self.friends_layout = RowLayout()
+        self.guilds_layout = RowLayout()
+        self.directory = DirectorySnapshot(f'{confdir}/directory.{self.user_id}.json')
+        self.directory_ready = threading.Event()
+        self.directory_lock = threading.Lock()
+        # Channels fetched by guild ID, and the guilds indexed so far (see `index_guilds`)
+        self.fetched_channels = {}
+        self.indexed_guilds = 0
+        self.lookup_pool = ThreadPoolExecutor(max_workers=LOOKUP_WORKERS)
+        self.lookup_lock = threading.Lock()
+        self.pending_lookups = {}
+        self.failed_lookups = OrderedDict()
+        self.outbox = Outbox(
+            self.send_message,
+            on_sent=self.on_message_sent,
+            on_failed=self.on_message_failed,
+            retries=SEND_RETRIES
+        )
+        self.pending = OrderedDict()
+        self.echoed = OrderedDict()
+        self.exporter = None
+        if self.args.metrics_file:
+            self.exporter = MetricsExporter(
+                self.metrics, self.args.metrics_file, self.args.metrics_interval)
+            self.exporter.start()
 
     def get_my_id(self):
         """
@@ -113,17 +300,53 @@ class MyClient():
         :return: the user ID associated with the token.
         """
 
-        response = requests.get(
-            f'{self.url}/users/@me',
-            headers=self.headers,
-            timeout=5
-        )
+        response = self.http.get('/users/@me', action='Get my ID')
+        me = response.json()
+        self.me = {'id': me['id'], 'username': me['username'],
+                   'global_name': me.get('global_name')}
+        self.ids.set(me['id'], me['username'])
+        self.session.remember(self.http.token, me)
 
-        if response.status_code != 200:
-            raise Exception(
-                f'Get my ID failed : {response.status_code} {response.text}')
+        return me['id']
+
+    def validate_session(self):
+        """
+        The function `validate_session` checks the cached profile against the Discord
+        API (or fetches it, after a password login), in the background: a renamed user
+        is updated, a rejected token is forgotten so the next run checks it before
+        anything else.
+        """
+
+        try:
+            self.get_my_id()
+        except TransportError as error:
+            if error.status_code == 401:
+                self.session.remember(self.http.token, None)
+                self.warn(f'{error}, restart chubbcord to log in again')
+
+    def warn(self, text):
+        """
+        The function `warn` reports a problem noticed outside of a command (background
+        work, exit).
+
+        :param text: What went wrong.
+        """
+
+        from rich.markup import escape
+        rprint(f'[bold][red]{escape(text)}[/red][/bold]')
+
+    @property
+    def console(self):
+        """ The rich console messages are printed to, created on first use """
+
+        if self._console is None:
+            from rich.console import Console
+            self._console = Console()
+        return self._console
 
-        return response.json()['id']
+    @console.setter
+    def console(self, console):
+        self._console = console
 
     def login(self):
         """
@@ -140,15 +363,7 @@ class MyClient():
             'gift_code_sku_id': None
         }
 
-        response = requests.post(
-            f'{self.url}/auth/login',
-            json=data,
-            timeout=5
-        )
-
-        if response.status_code != 200:
-            raise Exception(
-                f'Login failed : {response.status_code} {response.text}')
+        response = self.http.post('/auth/login', json=data, action='Login')
 
         self.user_id = response.json()['user_id']
         self.token = response.json()['token']
@@ -158,54 +373,207 @@ class MyClient():
             json.dump({'user_id': self.user_id, 'token': self.token,
                       'timestamp': self.timestamp}, f, indent=4)
 
-    def get_messages(self):
+    def get_messages(self, after=None, limit=MESSAGES_WINDOW, channel=None, before=None):
         """
         The function `get_messages` retrieves the latest 35 messages from a specified
-        channel using the Discord API.
+        channel using the Discord API, and archives them.
 
-        :return: a list of messages.
+        :param after: Only retrieve messages posted after this message ID.
+        :param limit: Maximum number of messages to retrieve (100 max).
+        :param channel: Channel ID, defaults to the current channel.
+        :param before: Only retrieve messages posted before this message ID.
+        :return: a list of `Message`, oldest first.
         """
 
+        channel = channel or self.args.channel
+
         params = {
-            'limit': '35',
+            'limit': str(limit),
         }
+        if after:
+            params['after'] = after
+        if before:
+            params['before'] = before
 
-        response = requests.get(
-            f'{self.url}/channels/{self.args.channel}/messages',
+        response = self.http.get(
+            f'/channels/{channel}/messages',
             params=params,
-            headers=self.headers,
-            timeout=5
+            action='Get messages',
+            # Watched channels in the background leave room to the current one
+            priority=INTERACTIVE if channel == self.args.channel else BACKGROUND
         )
 
-        if response.status_code != 200:
-            raise Exception(
-                f'Get messages failed : {response.status_code} {response.text}')
+        data = response.json()
+        self.harvest_identities(data)
+        messages = sorted((Message.from_json(message) for message in data),
+                          key=lambda message: int(message.id))
+        self.archive.store(channel, messages, page_span(messages, limit, after, before))
+
+        return messages
+
+    def get_store(self, channel=None):
+        """
+        The function `get_store` returns the message store of a channel, creating it
+        on first use. Past `STORE_CHANNELS` channels, the store used the least recently
+        is dropped (never the one of a printed channel), its messages are fetched
+        again if the channel is opened again.
+
+        :param channel: Channel ID, defaults to the current channel.
+        :return: the `MessageStore` of the channel.
+        """
 
-        messages = response.json()
-        messages.reverse()
+        channel = channel or self.args.channel
+        store = self.stores.get(channel)
+        if store is not None:
+            self.stores.move_to_end(channel)
+            return store
+
+        store = self.stores[channel] = MessageStore(STORE_LIMIT)
+        # The new store is the last one, never dropped here
+        idle = [other for other in self.stores
+                if other != self.args.channel and other not in self.watched]
+        for other in idle[:max(0, len(idle) - STORE_CHANNELS)]:
+            del self.stores[other]
+            self.scrollback.pop(other, None)
+
+        return store
+
+    def poll_messages(self, channel=None):
+        """
+        The function `poll_messages` retrieves only the messages posted since the newest
+        one already seen, following the `after` cursor page by page. Without a cursor
+        (first fetch, channel switch) or when too many pages arrived, the full window is
+        fetched instead.
+
+        :param channel: Channel ID, defaults to the current channel.
+        :return: a `MessageDelta` of what changed in the channel.
+        """
+
+        channel = channel or self.args.channel
+        with self.store_lock:
+            store = self.get_store(channel)
+            after = store.newest_id
+        if after is None:
+            return self.reset_messages(channel)
+
+        # The stores are only locked to merge, not while Discord answers
+        messages = []
+        for _ in range(POLL_MAX_PAGES):
+            page = self.get_messages(after=after, limit=POLL_PAGE_SIZE, channel=channel)
+            messages += page
+            if len(page) < POLL_PAGE_SIZE:
+                break
+            after = page[-1].id
+        else:
+            return self.reset_messages(channel)
+
+        with self.store_lock:
+            return store.merge(messages)
+
+    def reset_messages(self, channel=None):
+        """
+        The function `reset_messages` fetches the full window of a channel and merges
+        it into the store, detecting edited and deleted messages on the way.
+
+        :param channel: Channel ID, defaults to the current channel.
+        :return: a `MessageDelta` of what changed in the channel.
+        """
+
+        channel = channel or self.args.channel
+        messages = self.get_messages(channel=channel)
+        with self.store_lock:
+            delta = self.get_store(channel).merge(messages, complete=True)
+        self.archive.delete(channel, [message.id for message in delta.deleted])
+
+        return delta
+
+    def window_messages(self):
+        """
+        The function `window_messages` fetches the full window of the current channel,
+        to be printed from scratch (channel switch, :cr). Offline, the last archived
+        messages are served instead.
+
+        :return: a `MessageDelta` with every message of the window as inserted.
+        """
+
+        channel = self.args.channel
+        self.load_window(channel)
+        with self.store_lock:
+            return MessageDelta(inserted=self.get_store(channel).values()[-MESSAGES_WINDOW:])
+
+    def load_window(self, channel):
+        """
+        The function `load_window` fetches the full window of a channel into its store,
+        or its last archived messages when Discord can't be reached. The stores are
+        only locked to merge.
+
+        :param channel: Channel ID.
+        """
+
+        self.scrollback.pop(channel, None)
+        try:
+            self.reset_messages(channel)
+        except TransportError as error:
+            rprint(f'[bold][red]{error}, showing archived messages[/red][/bold]')
+            archived = self.archive.latest(channel, MESSAGES_WINDOW)
+            with self.store_lock:
+                self.get_store(channel).merge(archived)
+
+    def older_messages(self):
+        """
+        The function `older_messages` gets the page of messages preceding the oldest
+        one printed in the current channel (:up), from the archive when it holds
+        them all, else with a `before` request.
+
+        :return: a list of messages, oldest first (empty at the beginning of the channel).
+        """
+
+        channel = self.args.channel
+        with self.store_lock:
+            before = self.scrollback.get(channel)
+            if before is None:
+                window = self.get_store(channel).values()[-MESSAGES_WINDOW:]
+                if not window:
+                    return []
+                before = window[0].id
+
+        messages = self.archive.history(channel, before, MESSAGES_WINDOW)
+        self.count_cache('archive', messages is not None)
+        if messages is None:
+            messages = self.get_messages(channel=channel, before=before)
+
+        if messages:
+            self.scrollback[channel] = messages[0].id
 
         return messages
 
-    def manage_mentions(self, content):
+    def manage_mentions(self, content, message=None):
         """
         The function `manage_mentions` replaces user mentions, the
         `@everyone` mention, and the `@here` mention in a given
-        content with formatted text.
+        content with formatted text. Unknown users are shown by ID
+        and looked up in the background, never while rendering.
 
         :param content: The `content` parameter is a string that
-        represents the content of a message
+        represents the content of a message, escaped for rich
+        :param message: The message object the content belongs to,
+        re-rendered once its unknown users are resolved
         :return: the modified content after managing mentions.
         """
 
-        if '<@' in content and '<@&' not in content:
-            all_user_id = re.findall("<@.?\d\d\d\d\d\d\d\d\d\d\d\d\d\d\d\d\d\d>", content)
-            for user_id in all_user_id:
-                user_id = content.split('<@')[1].split('>')[0].strip('!')
-                if user_id not in self.ids:
-                    self.ids[user_id] = self.get_username_from_id(user_id)
-                username_in_content = self.ids[user_id]
-                content = content.replace(
-                        f'<@{user_id}>', f'[bold][dark_orange]@{username_in_content}[/dark_orange][/bold]')
+        from rich.markup import escape
+
+        def mention(match):
+            user_id = match.group(1)
+            username = self.ids.get(user_id)
+            self.count_cache('identity', username is not None)
+            if username is None:
+                self.queue_lookup(user_id, message)
+                username = user_id
+            return f'[bold][dark_orange]@{escape(username)}[/dark_orange][/bold]'
+
+        if '<@' in content:
+            content = MENTION.sub(mention, content)
         if '@everyone' in content:
             content = content.replace(
                 '@everyone', '[bold][dark_orange]@everyone[/dark_orange][/bold]')
@@ -215,109 +583,438 @@ class MyClient():
 
         return content
 
+    def harvest_identities(self, messages):
+        """
+        The function `harvest_identities` fills the identity cache with the
+        users carried by message payloads (authors, mentions, and the same
+        for referenced messages), so mentions rarely need a lookup.
+
+        :param messages: A list of message objects from the Discord API.
+        """
+
+        for message in messages:
+            if not message:
+                continue
+            users = list(message.get('mentions') or [])
+            if 'author' in message:
+                users.append(message['author'])
+            for user in users:
+                if 'id' in user and 'username' in user:
+                    self.ids.set(user['id'], user['username'])
+            if message.get('referenced_message'):
+                self.harvest_identities([message['referenced_message']])
+
+    def queue_lookup(self, user_id, message=None):
+        """
+        The function `queue_lookup` schedules the lookup of an unknown user
+        on the lookup pool. Lookups of the same user are only done once.
+
+        :param user_id: Unique identifier of a user.
+        :param message: Message to re-render once the user is resolved.
+        """
+
+        with self.lookup_lock:
+            if user_id in self.failed_lookups:
+                return
+            waiting = self.pending_lookups.get(user_id)
+            if waiting is None:
+                waiting = self.pending_lookups[user_id] = []
+                self.lookup_pool.submit(self.lookup_username, user_id)
+            if message is not None and all(m is not message for m in waiting):
+                waiting.append(message)
+
+    def lookup_username(self, user_id):
+        """
+        The function `lookup_username` resolves an unknown user on a worker,
+        then re-renders the messages of the current channel waiting for it.
+
+        :param user_id: Unique identifier of a user.
+        """
+
+        try:
+            username = self.get_username_from_id(user_id)
+        except TransportError:
+            username = user_id
+
+        with self.lookup_lock:
+            waiting = self.pending_lookups.pop(user_id, [])
+            if username == user_id:
+                self.failed_lookups[user_id] = True
+                while len(self.failed_lookups) > FAILED_LOOKUPS_LIMIT:
+                    self.failed_lookups.popitem(last=False)
+                return
+        self.ids.set(user_id, username)
+
+        with self.store_lock:
+            for message in waiting:
+                if self.running and self.is_watched(message.channel_id):
+                    self.print_message(message, ' [bright_black](resolved)[/bright_black]')
+
     def manage_attachments(self, content, message):
-        """ Manage attachments in a message (Download, display, etc.)
+        """ Manage attachments in a message (list their names)
 
         :param content: The `content` parameter is a string that
         represents the content of a message
-        :param message: The `message` parameter is a dict that
-        represents the message object
+        :param message: The `message` parameter is the `Message`
+        the content belongs to
         :return: the modified content after managing attachments.
         """
 
-        if message['attachments'] != []:
+        from rich.markup import escape
+
+        for attachment in message.attachments:
             content += (
-                f'[dark_green]{message["attachments"][0]["filename"]}[/dark_green]'
+                f'[dark_green]{escape(attachment.filename)}[/dark_green]'
             ) if content == '' else (
-                f'\n[dark_green]{message["attachments"][0]["filename"]}[/dark_green]'
+                f'\n[dark_green]{escape(attachment.filename)}[/dark_green]'
             )
 
-            if message['attachments'][0]['url'] not in self.attachments:
-                if self.args.attach:
-                    file = requests.get(
-                        message['attachments'][0]['url'], headers=self.headers
-                    )
-                    if file.status_code == 200:
-                        with open(f'{confdir}/tmp/{message["attachments"][0]["filename"]}', 'wb') as f:
-                            f.write(file.content)
-                        self.attachments.append(
-                            message['attachments'][0]['url']
-                        )
-
         return content
 
+    def manage_previews(self, message):
+        """ Print the previews of the attachments of a message, the ones not
+        downloaded yet are printed by `on_attachment_ready` once they are.
+        Only a size-bounded variant of each attachment is downloaded (a poster
+        frame for videos), originals are downloaded with :dl.
+
+        :param message: The `message` parameter is the `Message`
+        the attachments belong to
+        """
+
+        # Without chafa, there is nothing to download attachments for
+        if not self.previews.available:
+            return
+
+        for attachment in message.attachments:
+            variant = preview_variant(attachment)
+            if variant is None:
+                continue
+            path = self.attachment_cache.path(variant)
+            self.count_cache('attachment', path is not None)
+            if path is not None:
+                self.print_preview(message, path)
+            else:
+                self.attachment_cache.fetch(
+                    variant,
+                    lambda attachment, path: self.on_attachment_ready(message, path)
+                )
+
+    def download_original(self, filename=''):
+        """ Download the original of an attachment of the current channel
+
+        :param filename: Name of the attachment, the latest attachment if empty
+        """
+
+        from rich.markup import escape
+
+        for message in reversed(self.get_store().values()):
+            for attachment in reversed(message.attachments):
+                if not filename or attachment.filename == filename:
+                    rprint(f'[bright_black]Downloading {escape(attachment.filename)}...[/bright_black]')
+                    self.attachment_cache.fetch(attachment, self.on_original_ready)
+                    return
+
+        rprint('[bold][red]Attachment not found[/red][/bold]')
+
+    def on_original_ready(self, attachment, path):
+        """ Copy a downloaded original to the Downloads folder, without
+        overwriting any file
+
+        :param attachment: The downloaded `Attachment`
+        :param path: Path of the attachment in the cache
+        """
+
+        directory = homedir + '/Downloads'
+        if not os.path.isdir(directory):
+            directory = homedir
+
+        name, extension = os.path.splitext(os.path.basename(attachment.filename))
+        destination = f'{directory}/{name}{extension}'
+        copy = 1
+        while os.path.exists(destination):
+            destination = f'{directory}/{name} ({copy}){extension}'
+            copy += 1
+
+        shutil.copyfile(path, destination)
+        rprint(f'[dark_green]Saved {destination}[/dark_green]')
+
+    def on_attachment_ready(self, message, path):
+        """ Print the preview of a freshly downloaded attachment, if its message
+        is still on screen
+
+        :param message: The message object the attachment belongs to
+        :param path: Path of the downloaded attachment
+        """
+
+        with self.store_lock:
+            if self.running and self.is_watched(message.channel_id):
+                self.print_preview(message, path)
+
+    def print_preview(self, message, path):
+        """ Print an attachment in the terminal with chafa. Previews already
+        rendered are printed right away, the others are rendered by a worker
+        and printed by `on_preview_ready`.
+
+        :param message: The message object the attachment belongs to
+        :param path: Path of the downloaded attachment
+        """
+
+        if not self.previews.available:
+            return
+
+        render = self.previews.cached(path)
+        self.count_cache('preview', render is not None)
+        if render is not None:
+            self.write_preview(render)
+        else:
+            self.previews.submit(
+                path, lambda render: self.on_preview_ready(message, render))
+
+    def on_preview_ready(self, message, render):
+        """ Print a freshly rendered preview, if its message is still on screen
+
+        :param message: The message object the attachment belongs to
+        :param render: The ANSI preview
+        """
+
+        with self.store_lock:
+            if self.running and self.is_watched(message.channel_id):
+                self.write_preview(render)
+
+    def write_preview(self, render):
+        """ Write a rendered preview to the terminal
+
+        :param render: The ANSI preview
+        """
+
+        rprint(f' ')
+        sys.stdout.write(render)
+        sys.stdout.flush()
+        rprint(f' ')
+
     def manage_referenced_message(self, content, message):
         """ Manage referenced message in a message
 
         :param content: The `content` parameter is a string that
         represents the content of a message
-        :param message: The `message` parameter is a dict that
-        represents the message object
+        :param message: The `message` parameter is the `Message`
+        the content belongs to
         :return: the modified content after managing referenced message.
         """
 
-        try:
-            referenced_message = message['referenced_message']['content']
-            referenced_message = self.manage_mentions(referenced_message)
+        if message.referenced is None:
+            return content
+        if message.referenced is not DELETED:
+            from rich.markup import escape
+            referenced_message = escape(message.referenced.content)
+            referenced_message = self.manage_mentions(
+                referenced_message, message.referenced)
             referenced_message = self.manage_attachments(
-                referenced_message, message['referenced_message'])
+                referenced_message, message.referenced)
             content += f'\n  [magenta][/magenta] [italic][bright_black]{referenced_message}[/bright_black][/italic]'
-        except KeyError:
-            referenced_message = None
-        except TypeError:
+        else:
             referenced_message = "Original Message was deleted."
             content += f'\n  [magenta][/magenta] [italic][bright_black]{referenced_message}[/bright_black][/italic]'
 
         return content
 
-    def print_messages(self, messages):
+    def print_messages(self, delta):
         """
-        The function "print_messages" takes in a list of messages and prints them.
+        The function "print_messages" takes in a `MessageDelta` and prints it: new
+        messages as usual, then edited and deleted ones with a marker.
 
-        :param messages: The "messages" parameter is a list of messages that you want to
-        print
+        :param delta: The "delta" parameter is the `MessageDelta` returned by a merge
+        into a `MessageStore`.
         """
 
-        for message in messages:
-            date = message['timestamp'].replace('T', ' - ').split('.')[0]
-            username = message['author']['global_name']
-            if username == None:
-            	username = message['author']['username']
-            content = message['content']
-            content = self.manage_mentions(content)
+        self.print_entries(
+            [(message, '') for message in delta.inserted] +
+            [(message, ' [bright_black](edited)[/bright_black]') for message in delta.edited] +
+            [(message, ' [bright_black](deleted)[/bright_black]') for message in delta.deleted]
+        )
+
+    def print_message(self, message, tag=''):
+        """
+        The function "print_message" prints a single message.
+
+        :param message: The "message" parameter is the message object to print.
+        :param tag: Markup appended after the username (edited, deleted...).
+        """
+
+        self.print_entries([(message, tag)])
+
+    def print_entries(self, entries):
+        """
+        The function "print_entries" renders messages and writes them to the console
+        in a single flush (previews, written raw, split the batch).
+
+        :param entries: A list of (message, tag) tuples.
+        """
+
+        lines = []
+        for message, tag in entries:
+            head, content = self.format_message(message)
+            channel = message.channel_id or self.args.channel
+            if self.args.split:
+                if channel != self.last_printed_channel:
+                    lines.append(self.render_markup(f'[cyan]── {self.channel_label(channel)} ──[/cyan]'))
+            elif channel != self.args.channel:
+                head = f' [cyan]{self.channel_label(channel)}[/cyan]{head}'
+            self.last_printed_channel = channel
+            lines.append(self.render_line(message, f'{head}{tag} {content}'))
+
+            if message.attachments and self.args.attach:
+                self.flush_lines(lines)
+                self.manage_previews(message)
+
+        self.flush_lines(lines)
+
+    def channel_label(self, channel):
+        """
+        The function "channel_label" names a channel for the output of watched channels.
+
+        :param channel: Channel ID.
+        :return: #name for a guild channel, @username for a DM, else the ID.
+        """
+
+        return self.channel_names.get(channel, channel)
+
+    def flush_lines(self, lines):
+        """
+        The function "flush_lines" writes rendered lines to the console at once,
+        then empties the list.
+
+        :param lines: A list of lines rendered by `render_line`.
+        """
+
+        if lines:
+            with self.metrics.timer('render_stage_seconds', RENDER_BUCKETS, stage='print'):
+                self.console.file.write(''.join(lines))
+                self.console.file.flush()
+            lines.clear()
+
+    def render_markup(self, markup):
+        """
+        The function "render_markup" renders rich markup the way the console prints it.
+
+        :param markup: A rich formatted line.
+        :return: the line as text with ANSI escape codes, ending with a newline.
+        """
+
+        with self.metrics.timer('render_stage_seconds', RENDER_BUCKETS, stage='print'):
+            with self.console.capture() as capture:
+                self.console.print(markup)
+        return capture.get()
+
+    def render_line(self, message, line):
+        """
+        The function "render_line" renders the line of a message once: the output is
+        memoized along the formatted message (see `format_message`), by line (tags and
+        channel label included) and console width, so a repaint only writes it.
+
+        :param message: The message the line was formatted from, by `format_message`.
+        :param line: The rich formatted line.
+        :return: the line as text with ANSI escape codes.
+        """
+
+        memo = self.render_memo.get(message.id)
+        if memo is None:
+            return self.render_markup(line)
+
+        rendered = memo[3]
+        key = (line, self.console.width)
+        output = rendered.get(key)
+        if output is None:
+            # Tags come and go (pending, edited...), only the last few lines are kept
+            if len(rendered) >= RENDERED_LINES:
+                rendered.pop(next(iter(rendered)))
+            output = rendered[key] = self.render_markup(line)
+
+        return output
+
+    def format_message(self, message):
+        """
+        The function "format_message" formats a message in a rich format, once:
+        the result (and its rendered lines, see `render_line`) is memoized by message
+        ID and `edited_timestamp`, and by the version of the identity cache while the
+        message mentions unknown users.
+
+        :param message: The "message" parameter is the message object to format.
+        :return: the (username part, content part) of the rich formatted line.
+        """
+
+        version = self.ids.version
+        memo = self.render_memo.get(message.id)
+        if memo is not None and memo[0] == message.edited_timestamp \
+                and memo[1] in (None, version):
+            self.render_memo.move_to_end(message.id)
+            self.count_cache('render', True)
+            return memo[2]
+        self.count_cache('render', False)
+
+        unresolved = self.has_unknown_mentions(message)
+
+        from rich.markup import escape
+
+        date = message.timestamp.replace('T', ' - ').split('.')[0]
+        username = escape(message.author_name)
+        content = escape(message.content)
+        with self.metrics.timer('render_stage_seconds', RENDER_BUCKETS, stage='mentions'):
+            content = self.manage_mentions(content, message)
+        with self.metrics.timer('render_stage_seconds', RENDER_BUCKETS, stage='attachments'):
             content = self.manage_attachments(content, message)
+        with self.metrics.timer('render_stage_seconds', RENDER_BUCKETS, stage='referenced'):
             content = self.manage_referenced_message(content, message)
 
-            rprint(
-                f' [bold][blue][/blue] [green]\[[/green][red]{username}[/red][green]][/green][/bold] {content}')
+        formatted = (
+            f' [bold][blue][/blue] [green]\[[/green][red]{username}[/red][green]][/green][/bold]',
+            content
+        )
+
+        self.render_memo[message.id] = (
+            message.edited_timestamp, version if unresolved else None, formatted, {})
+        while len(self.render_memo) > RENDER_MEMO_SIZE:
+            self.render_memo.popitem(last=False)
+
+        return formatted
 
-            if message['attachments'] != [] and self.args.attach:
-                if os.name == 'posix' and 'Chafa version' in sp.getoutput('chafa --version'):
-                    rprint(f' ')
-                    os.system(
-                        f'chafa {homedir}/.chubbcord/tmp/{message["attachments"][0]["filename"]} --size=80x25 --animate=off'
-                    )
-                    rprint(f' ')
+    def count_cache(self, cache, hit):
+        """
+        The function "count_cache" counts a lookup in one of the caches, for :stats.
 
-    def diff_messages(self, messages1, messages2):
+        :param cache: Name of the cache (identity, render, preview, attachment, archive).
+        :param hit: True if the cache had the value.
         """
-        The function `diff_messages` takes two lists of messages and returns a new list
-        containing messages that are in the first list but not in the second list.
 
-        :param messages1: A list of messages
-        :param messages2: An other list of messages
+        self.metrics.inc('cache_requests_total', cache=cache, result='hit' if hit else 'miss')
 
-        :return: a list of messages that are present in `messages1` but not in `messages2`.
+    def has_unknown_mentions(self, message):
         """
+        The function "has_unknown_mentions" tells if a message, or the message it
+        replies to, mentions users missing from the identity cache.
+
+        :param message: The "message" parameter is the message object to check.
+        :return: True if a mentioned user is unknown.
+        """
+
+        texts = [message.content]
+        if message.referenced is not None:
+            texts.append(message.referenced.content)
 
-        return [message for message in messages1 if message not in messages2]
+        return any(self.ids.get(user_id) is None
+                   for text in texts for user_id in MENTION.findall(text))
 
-    def send_message(self, content, attachments=[]):
+    def send_message(self, content, attachments=[], channel=None, nonce=None):
         """
         The `send_message` function sends a message to a specified channel using the
-        Discord API.
+        Discord API, and waits for the answer (see `queue_message` to send in the
+        background).
 
         :param content: Message content that you want to send.
+        :param attachments: Uploaded attachments to send with the message.
+        :param channel: Channel ID, defaults to the current channel.
+        :param nonce: Nonce of the message: Discord answers with the message already
+        posted if the same nonce is sent twice.
 
         :return: the JSON response from the API call.
         """
@@ -326,22 +1023,135 @@ class MyClient():
             'content': content,
             'attachments': attachments
         }
+        if nonce:
+            data['nonce'] = nonce
+            data['enforce_nonce'] = True
 
-        response = requests.post(
-            f'{self.url}/channels/{self.args.channel}/messages',
-            headers=self.headers,
+        response = self.http.post(
+            f'/channels/{channel or self.args.channel}/messages',
             json=data,
-            timeout=5
+            action='Send message'
         )
+        # Answers usually follow
+        self.scheduler.bump(channel or self.args.channel)
 
-        if response.status_code != 200:
-            raise Exception(
-                f'Send message failed : {response.status_code} {response.text}')
+        return response.json()
 
-        #self.refresh_screen()
-        #os.system(f'printf "\eM\r\e[2K"')
+    def queue_message(self, content, channel=None):
+        """
+        The `queue_message` function sends a message in the background, in order with
+        the ones queued before, and prints it right away as pending. Its copy from
+        Discord is recognized by its nonce (see `reconcile`) and not printed again.
 
-        return response.json()
+        :param content: Message content that you want to send.
+        :param channel: Channel ID, defaults to the current channel.
+        """
+
+        channel = channel or self.args.channel
+        nonce = new_nonce()
+        # Never looked up: typing must not wait for the network
+        me = self.me
+        local = Message(
+            id=nonce,
+            channel_id=channel,
+            author_id=self.user_id,
+            username=me['username'] or self.user_id,
+            global_name=me['global_name'],
+            timestamp=time.strftime('%Y-%m-%dT%H:%M:%S.000000+00:00', time.gmtime()),
+            content=content,
+            nonce=nonce
+        )
+
+        with self.store_lock:
+            self.pending[nonce] = local
+            self.print_message(local, PENDING_TAG)
+        self.outbox.put(channel, content, nonce)
+
+    def on_message_sent(self, channel, nonce, message):
+        """
+        The `on_message_sent` function is called by the outbox once a queued message
+        is posted: its copy is remembered, so it isn't printed again by a poll.
+
+        :param channel: Channel ID.
+        :param nonce: Nonce of the message.
+        :param message: The message posted, from Discord.
+        """
+
+        with self.store_lock:
+            # Already reconciled if a poll or the gateway was faster than the answer
+            if self.pending.pop(nonce, None) is None:
+                return
+            self.echoed[message['id']] = channel
+            while len(self.echoed) > ECHOED_LIMIT:
+                self.echoed.popitem(last=False)
+
+    def on_message_failed(self, channel, nonce, content, error):
+        """
+        The `on_message_failed` function is called by the outbox when a queued message
+        can't be sent, even after retries: it is printed again, marked as not sent.
+
+        :param channel: Channel ID.
+        :param nonce: Nonce of the message.
+        :param content: Message content.
+        :param error: The last `TransportError`.
+        """
+
+        from rich.markup import escape
+
+        with self.store_lock:
+            local = self.pending.pop(nonce, None)
+            if local is not None and self.running and self.is_watched(channel):
+                self.print_message(local, f' [red](not sent: {escape(str(error))})[/red]')
+            else:
+                rprint(f'[bold][red]{escape(f"{error}, not sent: {content}")}[/red][/bold]')
+
+    def reconcile(self, delta):
+        """
+        The function `reconcile` removes from the messages a poll or the gateway found
+        the ones already printed by `queue_message`, recognized by their ID once sent,
+        or by their nonce (by their author and content for polls, which come without
+        the nonce) while they are still pending.
+
+        :param delta: A `MessageDelta` of new messages.
+        :return: the `MessageDelta` left to print.
+        """
+
+        if not self.pending and not self.echoed:
+            return delta
+
+        inserted = []
+        for message in delta.inserted:
+            if self.echoed.pop(message.id, None) is not None:
+                continue
+            local = self.pending.get(message.nonce)
+            if local is None and message.author_id == self.user_id:
+                local = next((local for local in self.pending.values()
+                              if local.channel_id == message.channel_id
+                              and local.content == message.content), None)
+            if local is not None:
+                del self.pending[local.nonce]
+                continue
+            inserted.append(message)
+
+        return MessageDelta(inserted, delta.edited, delta.deleted)
+
+    def resolve_username(self, user_id):
+        """
+        The function `resolve_username` returns the username of a user from the identity
+        cache, and only looks it up on a cache miss.
+
+        :param user_id: Unique identifier of a user.
+
+        :return: the username of the user, or the user_id itself if it can't be found.
+        """
+
+        username = self.ids.get(user_id)
+        if username is None:
+            username = self.get_username_from_id(user_id)
+            if username != user_id:
+                self.ids.set(user_id, username)
+
+        return username
 
     def get_username_from_id(self, user_id):
         """
@@ -351,29 +1161,28 @@ class MyClient():
         :param user_id: Unique identifier of a user.
 
         :return: the username of the user with the given user_id if the response status
-        code is 200. Otherwise, it returns the user_id itself.
+        code is 200. Otherwise (including when still rate limited after the transport
+        retries), it returns the user_id itself.
         """
 
-        response = requests.get(
-            f'https://discordlookup.mesalytic.moe/v1/user/{user_id}',
-            timeout=5
+        response = self.http.get(
+            f'{LOOKUP_URL}/{user_id}',
+            expected=None,
+            priority=BACKGROUND
         )
 
         if response.status_code != 200:
-            if 'rate limited' in response.text:
-                time.sleep(2)
-                return self.get_username_from_id(user_id)
             return user_id
 
         return response.json()['username']
 
-    def request_upload_attachment(self, path, size):
+    def request_upload_attachment(self, paths, channel=None):
         """
-        This function requests an upload link for a file to a specified channel using
+        This function requests an upload link for files to a specified channel using
         the Discord API.
 
-        :param path: Path of the file you want to send.
-        :param size: Size of the file you want to send.
+        :param paths: Paths of the files you want to send.
+        :param channel: Channel ID, defaults to the current channel.
 
         :return: the JSON response from the API call.
         """
@@ -381,241 +1190,288 @@ class MyClient():
         data = {
             'files': [
                 {
-                    'filename': path,
-                    'file_size': size,
-                },
+                    'id': str(index),
+                    'filename': os.path.basename(path),
+                    'file_size': os.path.getsize(path),
+                }
+                for index, path in enumerate(paths)
             ],
         }
 
-        response = requests.post(
-            f'{self.url}/channels/{self.args.channel}/attachments',
-            headers=self.headers,
+        response = self.http.post(
+            f'/channels/{channel or self.args.channel}/attachments',
             json=data,
+            action='Put attachment'
         )
 
-        if response.status_code != 200:
-            raise Exception(
-                f'Put attachment failed : {response.status_code} {response.text}')
-
         return response.json()
 
-    def upload_attachment(self, path, link, filename):
+    def upload_attachment(self, path, link, progress=None):
         """
-        This function uploads a file to a specified channel using the Discord API.
+        This function uploads a file to Discord storage, streamed from disk in chunks
+        and resumed where it stopped if the connection drops.
 
         :param path: Path of the file you want to send.
         :param link: Upload link of the file you want to send.
-        :param filename: Name of the file in Discord storage.
+        :param progress: `UploadProgress` the bytes sent are reported to.
 
         :return: 1 if the upload was successful.
         """
 
-        params = {
-            'upload_id': link.split('upload_id=')[1]
-        }
-
-        with open(path, 'rb') as f:
-            data = f.read()
-
-        response = requests.put(
-            f'https://discord-attachments-uploads-prd.storage.googleapis.com/{filename}',
-            params=params,
-            headers=self.headers,
-            data=data,
-        )
-
-        if response.status_code != 200:
-            raise Exception(
-                f'Put attachment failed : {response.status_code} {response.text}')
+        upload_file(self.http, path, link, progress)
 
         return 1
 
-    def put_attachment(self, path, size, content):
+    def put_attachments(self, paths, content):
         """
-        This function sends a file to a specified channel using the Discord API.
+        This function uploads files in parallel, then sends them in a single message
+        to the current channel. It is meant to run in a thread, and reports the
+        progress of large uploads.
 
-        :param path: The `path` parameter is the path of the file you want to send.
-        :param size: The `size` parameter is the size of the file you want to send.
+        :param paths: The paths of the files you want to send.
         :param content: The `content` parameter is the message content that you want
         to send.
 
-        :return: Nothing if the file can't be found.
+        :return: Nothing if a file can't be found.
         """
 
-        if not os.path.isfile(path):
-            rprint(f'[bold][red]Is {path} a file?[/red][/bold]')
-            return
+        for path in paths:
+            if not os.path.isfile(path):
+                rprint(f'[bold][red]Is {path} a file?[/red][/bold]')
+                return
+
+        channel = self.args.channel
+        progress = UploadProgress(sum(os.path.getsize(path) for path in paths))
+        done = threading.Event()
 
-        request_attachment = self.request_upload_attachment(path, size)
-        upload_link = request_attachment['attachments'][0]['upload_url']
-        upload_filename = request_attachment['attachments'][0]['upload_filename']
-        self.upload_attachment(path, upload_link, upload_filename)
+        def report():
+            while not done.wait(UPLOAD_REPORT_INTERVAL):
+                rprint(f'[bright_black]Uploading... {progress}[/bright_black]')
 
-        attachment_data = [
-            {
-                'id': '0',
-                'filename': path,
-                'uploaded_filename': upload_filename,
-            },
-        ]
+        threading.Thread(target=report, daemon=True).start()
+        try:
+            request_attachment = self.request_upload_attachment(paths, channel)
+            uploads = request_attachment['attachments']
+            with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+                list(pool.map(
+                    lambda upload, path: self.upload_attachment(path, upload['upload_url'], progress),
+                    uploads, paths
+                ))
+
+            attachment_data = [
+                {
+                    'id': str(index),
+                    'filename': os.path.basename(path),
+                    'uploaded_filename': upload['upload_filename'],
+                }
+                for index, (upload, path) in enumerate(zip(uploads, paths))
+            ]
+
+            self.send_message(content, attachment_data, channel)
+        except TransportError as error:
+            rprint(f'[bold][red]{error}[/red][/bold]')
+            return
+        finally:
+            done.set()
 
-        self.send_message(content, attachment_data)
+        rprint(f'[bright_black]Uploaded {len(paths)} file(s), {progress}[/bright_black]')
 
     def list_friends(self):
         """ Get friends from Discord API """
 
-        response = requests.get(
-            f'{self.url}/users/@me/channels',
-            headers=self.headers,
-            timeout=5
-        )
-
-        if response.status_code != 200:
-            raise Exception(
-                f'Get friends failed : {response.status_code} {response.text}')
+        response = self.http.get(
+            '/users/@me/channels', action='Get friends', priority=BACKGROUND)
 
         list_friends = [element for element in response.json()
                         if element['type'] == 1]
+        self.index_friends(list_friends)
         self.friends = list_friends
 
     def list_guilds(self):
-        """ Get guilds's user from Discord API """
+        """
+        Get guilds's user from Discord API, then their channels in the background.
 
-        response = requests.get(
-            f'{self.url}/users/@me/guilds',
-            headers=self.headers,
-            timeout=5
-        )
+        Channels are fetched by a small pool of workers and stream into `self.guilds`
+        in listing order (see `index_guilds`). Until then, the last known channels of
+        the guild are kept (`channels` is None for a guild never seen before).
 
-        if response.status_code != 200:
-            raise Exception(
-                f'Get guilds failed : {response.status_code} {response.text}')
+        :return: the futures of the channel fetches.
+        """
 
-        self.guilds = response.json()
+        response = self.http.get(
+            '/users/@me/guilds', action='Get guilds', priority=BACKGROUND)
 
-        for guild in self.guilds:
-            self.list_channels_from_guild(guild['id'])
-            time.sleep(0.5)
+        known = {guild['id']: guild['channels'] for guild in self.guilds}
+        guilds = response.json()
+        for guild in guilds:
+            guild['channels'] = known.get(guild['id'])
+        with self.directory_lock:
+            self.guilds = guilds
+            self.fetched_channels = {}
+            self.indexed_guilds = 0
 
-    def rprint_friends(self):
-        """ Print friends in a rich format """
-
-        content = ''
-        local_id = 0
-
-        for friend in self.friends:
-            local_id += 1
-            friend_print = f'   [#E01E5A]{local_id}[/#E01E5A] - ' + \
-                f'{friend["recipients"][0]["username"]} - {friend["id"]}'
-            friend_length = len(friend_print.replace(
-                '[#E01E5A]', '').replace('[/#E01E5A]', ''))
-
-            # Emoji or Special char. are 2 chars long
-            for char in friend["recipients"][0]["username"]:
-                if char in EMOJI_DATA:
-                    friend_length += 1
-
-            if friend_length > 80:
-                friend_print = friend_print.replace(
-                    friend["recipients"][0]["id"],
-                    friend["recipients"][0]["id"][:80 -
-                                                  friend_length - 8] + '...'
-                )
-                friend_length = len(friend_print.replace(
-                    '[#E01E5A]', '').replace('[/#E01E5A]', '')) + 1
+        pool = ThreadPoolExecutor(max_workers=DIRECTORY_WORKERS)
+        futures = [pool.submit(self.load_guild_channels, guild) for guild in guilds]
+        pool.shutdown(wait=False)
 
-            friend_print += ' ' * \
-                (80 - friend_length) + ' \n'
+        return futures
 
-            self.friends[self.friends.index(friend)]['local_id'] = local_id
+    def load_guild_channels(self, guild):
+        """ Worker filling the channels of a guild
 
-            content += friend_print
+        :param guild: the guild object to fill
+        """
 
-        content += ' '
+        try:
+            channels = self.list_channels_from_guild(guild['id'])
+        except TransportError:
+            channels = None
+
+        with self.directory_lock:
+            self.fetched_channels[guild['id']] = channels
+            self.index_guilds()
+
+    def index_guilds(self):
+        """ Index the fetched channels of the guilds in listing order: the workers
+        finish in any order, but a guild waits for the ones listed before it, so the
+        channels seen for the first time get predictable local IDs. Called with
+        `directory_lock` held.
+        """
 
-        return content
+        while self.indexed_guilds < len(self.guilds):
+            guild = self.guilds[self.indexed_guilds]
+            if guild['id'] not in self.fetched_channels:
+                return
 
-    def list_channels_from_guild(self, guild_id):
-        """ Get channels from a guild
+            channels = self.fetched_channels.pop(guild['id'])
+            if channels is not None:
+                self.index_channels(channels)
+                guild['channels'] = channels
+            elif guild['channels'] is None:
+                # Couldn't be fetched, and never seen before
+                guild['channels'] = []
+            self.indexed_guilds += 1
 
-        :param guild_id: the id of the guild you want to get channels from
+    def index_channels(self, channels):
+        """ Give channels their stable local ID and map it in `self.list_id`
+
+        :param channels: the channel objects of a guild
         """
 
-        response = requests.get(
-            f'{self.url}/guilds/{guild_id}/channels',
-            headers=self.headers,
-            timeout=5
-        )
+        for channel in channels:
+            channel['local_id'] = self.directory.local_id(channel['id'])
+            self.list_id[channel['local_id']] = channel['id']
+            self.channel_names[channel['id']] = f'#{channel["name"]}'
 
-        if response.status_code != 200:
-            raise Exception(
-                f'Get channels failed : {response.status_code} {response.text}')
+    def index_friends(self, friends):
+        """ Name the DM channels for the output of watched channels
 
-        list_channels = [channel for channel in response.json()
-                         if channel['type'] == 0]
-        self.guilds[self.guilds.index(
-            [guild for guild in self.guilds if guild['id'] == guild_id][0])]['channels'] = list_channels
+        :param friends: the DM channel objects
+        """
 
-    def rprint_guilds(self):
-        """ Print guilds and channels in a rich format """
+        for friend in friends:
+            self.channel_names[friend['id']] = f'@{friend["recipients"][0]["username"]}'
+
+    def load_directory(self):
+        """ Serve the guilds, channels and DM lists of the last run from the snapshot
+
+        :return: True if a snapshot was found.
+        """
 
-        # TODO: Rework or idk, the code looks horrible af
-        content = ''
-        local_id = 0
+        if not self.directory.load():
+            return False
 
+        self.friends = self.directory.friends
+        self.guilds = self.directory.guilds
+        self.index_friends(self.friends)
         for guild in self.guilds:
-            guild_print = f'   - {guild["name"]} -'
-            if guild['owner']:
-                guild_print += ' [#E01E5A](owner)[/#E01E5A]'
+            if guild['channels'] is not None:
+                self.index_channels(guild['channels'])
 
-            guild_length = len(guild_print.replace(
-                '[#E01E5A]', '').replace('[/#E01E5A]', '')
-            )
+        return True
 
-            if guild_length < 80:
-                guild_print += ' ' * \
-                    (79 - guild_length) + ' \n'
+    def rprint_friends(self):
+        """ Print friends in a rich format
 
-            content += guild_print
+        Local IDs are given in the same pass, and only the rows of friends that
+        changed since the last call are rendered again.
+        """
 
-            for channel in self.guilds[self.guilds.index(guild)]['channels']:
-                local_id += 1
-                channel_print = f'      [#E01E5A]{local_id}[/#E01E5A] - {channel["name"]} - {channel["id"]}'
-                channel_length = len(channel_print.replace(
-                    '[#E01E5A]', '').replace('[/#E01E5A]', ''))
+        rows = []
+        for local_id, friend in enumerate(self.friends, start=1):
+            friend['local_id'] = local_id
+            rows.append((
+                ('   ', None, False),
+                (str(local_id), '#E01E5A', False),
+                (' - ', None, False),
+                (friend['recipients'][0]['username'], None, True),
+                (f' - {friend["id"]}', None, False),
+            ))
 
-                # Emoji or Special char. are 2 chars long
-                for char in channel['name']:
-                    if char in EMOJI_DATA or char in ['｜']:
-                        channel_length += 1
+        return self.friends_layout.render(rows) + ' '
 
-                if channel_length > 80:
-                    channel_print = channel_print.replace(
-                        channel['name'], channel['name'][:80 - channel_length - 8] + '...')
-                    channel_length = len(channel_print.replace(
-                        '[#E01E5A]', '').replace('[/#E01E5A]', '')) + 1
+    def list_channels_from_guild(self, guild_id):
+        """ Get channels from a guild
 
-                channel_print += ' ' * \
-                    (79 - channel_length) + ' \n'
+        :param guild_id: the id of the guild you want to get channels from
+        :return: the text channels of the guild.
+        """
 
-                self.guilds[self.guilds.index(guild)]['channels'][self.guilds[self.guilds.index(guild)]['channels'].index(
-                    channel)]['local_id'] = local_id
+        response = self.http.get(
+            f'/guilds/{guild_id}/channels', action='Get channels', priority=BACKGROUND)
 
-                content += channel_print
+        return [channel for channel in response.json()
+                if channel['type'] == 0]
 
-        content += ' '
+    def rprint_guilds(self):
+        """ Print guilds and channels in a rich format
 
-        return content
+        Only the rows of guilds and channels that changed since the last call are
+        rendered again.
+        """
+
+        rows = []
+        for guild in self.guilds:
+            guild_row = (('   - ', None, False), (guild['name'], None, True), (' -', None, False))
+            if guild['owner']:
+                guild_row += ((' ', None, False), ('(owner)', '#E01E5A', False))
+            rows.append(guild_row)
+
+            # Channels of this guild are still being fetched
+            if guild['channels'] is None:
+                rows.append((('      ', None, False), ('loading...', 'bright_black', False)))
+                continue
+
+            for channel in guild['channels']:
+                rows.append((
+                    ('      ', None, False),
+                    (str(channel['local_id']), '#E01E5A', False),
+                    (' - ', None, False),
+                    (channel['name'], None, True),
+                    (f' - {channel["id"]}', None, False),
+                ))
+
+        return self.guilds_layout.render(rows) + ' '
 
     def refresh_screen(self):
         """ Refresh the screen and print the last messages """
 
-        os.system('clear') if os.name == 'posix' else os.system('cls')
-        self.messages = []
-        new_messages = self.get_messages()
-        diff_messages = self.diff_messages(new_messages, self.messages)
-        self.print_messages(diff_messages)
-        self.messages = new_messages
+        # Fetched before locking the stores, so sending never waits for Discord
+        channel = self.args.channel
+        self.load_window(channel)
+        with self.store_lock:
+            # Switched to another channel meanwhile, which prints its own window
+            if self.args.channel != channel:
+                return
+            # Cleared once locked: what a poll printed meanwhile is in the window
+            os.system('clear') if os.name == 'posix' else os.system('cls')
+            self.last_printed_channel = None
+            window = MessageDelta(inserted=self.get_store(channel).values()[-MESSAGES_WINDOW:])
+            # Pending messages already in the window are printed as posted
+            self.reconcile(window)
+            self.print_messages(window)
+            self.print_entries([(local, PENDING_TAG) for local in self.pending.values()
+                                if local.channel_id == self.args.channel])
 
     def internal_command(self, command):
         """
@@ -630,20 +1486,30 @@ class MyClient():
                    '    [dark_orange]COMMAND LIST:       [/dark_orange] \n' +
                    '      :help - Show this help      \n' +
                    '      :q - Exit chubbcord         \n' +
-                   '      :attach - Attach a file     \n' +
+                   '      :attach - Attach files      \n' +
                    '        (ex: :attach:poop.png:text)\n'+
+                   '        (ex: :attach:a.png,b.gif:)\n'+
                    '      :cr - Clear and Refresh     \n' +
+                   '      :up - Print older messages  \n' +
+                   '      :search - Search history    \n' +
+                   '        (ex: :search:deploy fail*)\n' +
+                   '        (filters: in:#chan from:bob\n' +
+                   '         after:2024-03-01 before:..)\n' +
                    '      :li - List Guilds & Chan.   \n'
                    '      :dm - List Direct Messages  \n'
+                   '      :watch - List watched chan. \n'
+                   '        (ex: :watch:3, :watch:dm:2)\n'
+                   '      :unwatch - Stop watching    \n'
+                   '        (ex: :unwatch:3)          \n'
                    '      :we - Print welcome message \n'
+                   '      :dl - Download attachment   \n'
+                   '        (ex: :dl or :dl:poop.png) \n'
+                   '      :stats - Timings and caches \n'
                    '[/#7289DA]'
                    )
             rprint()
 
         elif command == ':q':
-            if self.running:
-                self.kill_thread = True
-                self.main_loop_thread.join()
             self.clean()
             sys.exit()
 
@@ -651,21 +1517,58 @@ class MyClient():
             self.refresh_screen()
 
         elif ':attach:' in command:
-            attachment = command.split(':')[2]
+            attachments = [path.strip() for path in command.split(':')[2].split(',')]
             if len(command.split(':')) == 4:
                 content = command.split(':')[3]
             else:
                 content = ''
-            if os.path.exists(attachment):
-                self.put_attachment(
-                    attachment, os.path.getsize(attachment), content
-                )
+            if all(os.path.exists(attachment) for attachment in attachments):
+                # Uploads run in the background so the prompt stays responsive
+                threading.Thread(
+                    target=self.put_attachments,
+                    args=(attachments, content),
+                    daemon=True
+                ).start()
             else:
                 rprint('[bold][red]File not found[/red][/bold]')
 
+        elif command == ':dl' or command.startswith(':dl:'):
+            self.download_original(command[4:])
+
+        elif command == ':up':
+            try:
+                messages = self.older_messages()
+            except TransportError as error:
+                rprint(f'[bold][red]{error}[/red][/bold]')
+                return
+
+            if not messages:
+                rprint('[bright_black]Beginning of the channel[/bright_black]')
+                return
+            rprint(f'[bright_black]── {len(messages)} older messages ──[/bright_black]')
+            with self.store_lock:
+                self.print_entries([(message, '') for message in messages])
+
+        elif command.startswith(':search:'):
+            if not self.archive.searchable:
+                rprint('[bold][red]Search needs SQLite with FTS5[/red][/bold]')
+                return
+            try:
+                results = self.search_messages(command[8:])
+            except ValueError as error:
+                rprint(f'[bold][red]{error} (ex: :search:deploy from:bob in:#general after:2024-03-01)[/red][/bold]')
+                return
+
+            rprint(f'[bright_black]── {len(results)} result(s) ──[/bright_black]')
+            with self.store_lock:
+                self.print_entries([(message, '') for message in results])
+
         elif command == ':we':
             self.print_welcome()
 
+        elif command == ':stats':
+            self.print_stats()
+
         elif command == ':li':
             rprint('\n[#7289DA]' +
                    ' \n' +
@@ -673,30 +1576,17 @@ class MyClient():
                    )
 
             with patch_stdout(raw=True):
-                self.args.channel = prompt('Channel ID: ')
+                local_id = prompt('Channel ID: ')
             try:
-                int(self.args.channel)
+                int(local_id)
             except ValueError:
-                if self.running:
-                    self.kill_thread = True
-                    self.main_loop_thread.join()
+                self.clean()
                 sys.exit('Channel ID must be an integer')
             except KeyboardInterrupt:
-                if self.running:
-                    self.kill_thread = True
-                    self.main_loop_thread.join()
                 self.clean()
                 sys.exit()
 
-            if self.running:
-                self.kill_thread = True
-                self.main_loop_thread.join()
-                self.running = False
-
-            self.args.channel = self.list_id[int(self.args.channel)]
-            self.main_loop_thread = threading.Thread(target=self.main_loop)
-            self.main_loop_thread.start()
-            self.refresh_screen()
+            self.focus_channel(self.list_id[int(local_id)])
 
         elif command == ':dm':
             rprint('\n[#7289DA]' +
@@ -705,34 +1595,150 @@ class MyClient():
                    )
 
             with patch_stdout(raw=True):
-                self.args.channel = prompt('Message ID: ')
+                local_id = prompt('Message ID: ')
             try:
-                int(self.args.channel)
+                int(local_id)
             except ValueError:
-                if self.running:
-                    self.kill_thread = True
-                    self.main_loop_thread.join()
+                self.clean()
                 sys.exit('Channel ID must be an integer')
             except KeyboardInterrupt:
-                if self.running:
-                    self.kill_thread = True
-                    self.main_loop_thread.join()
                 self.clean()
                 sys.exit()
 
-            if self.running:
-                self.kill_thread = True
-                self.main_loop_thread.join()
-                self.running = False
+            self.focus_channel(self.friends[int(local_id) - 1]['id'])
+
+        elif command == ':watch':
+            channels = sorted(self.watched, key=self.channel_label)
+            rprint('[bright_black]Watching: ' +
+                   (', '.join(self.channel_label(channel) for channel in channels) or 'nothing') +
+                   '[/bright_black]')
+
+        elif command.startswith(':watch:') or command.startswith(':unwatch:'):
+            channel = self.parse_channel(command.split(':', 2)[2])
+            if channel is None:
+                rprint('[bold][red]Unknown channel (ex: :watch:3, :watch:dm:2)[/red][/bold]')
+            elif command.startswith(':watch:'):
+                self.watched.add(channel)
+                self.scheduler.watch(channel, now=True)
+            else:
+                self.watched.discard(channel)
+                if channel != self.args.channel:
+                    self.scheduler.unwatch(channel)
 
-            self.args.channel = self.friends[int(self.args.channel) - 1]['id']
-            self.main_loop_thread = threading.Thread(target=self.main_loop)
-            self.main_loop_thread.start()
-            self.refresh_screen()
+    def print_stats(self):
+        """
+        The `print_stats` function prints the metrics of the session (:stats): requests
+        per endpoint, cache hit rates, render stages and poll lag. Timings are the
+        upper bound of their histogram bucket.
+        """
+
+        from rich.table import Table
+
+        def ms(seconds):
+            return f'{seconds * 1000:.1f}'
+
+        requests = Table(title='Requests', title_justify='left', header_style='dark_orange')
+        for column in ('endpoint', 'count', '429', 'errors', 'p50 ms', 'p95 ms', 'max ms'):
+            requests.add_column(column, justify='left' if column == 'endpoint' else 'right')
+        statuses = self.metrics.counter_values('http_requests_total')
+        for labels, histogram in sorted(self.metrics.histogram_values('http_request_seconds').items()):
+            route = dict(labels)['route']
+            counts = {dict(key)['status']: value for key, value in statuses.items()
+                      if dict(key)['route'] == route}
+            requests.add_row(
+                route, str(histogram.count), str(counts.get('429', 0)), str(counts.get('error', 0)),
+                ms(histogram.quantile(0.5)), ms(histogram.quantile(0.95)), ms(histogram.max))
+
+        caches = Table(title='Caches', title_justify='left', header_style='dark_orange')
+        for column in ('cache', 'hits', 'misses', 'hit rate'):
+            caches.add_column(column, justify='left' if column == 'cache' else 'right')
+        lookups = {}
+        for labels, value in self.metrics.counter_values('cache_requests_total').items():
+            labels = dict(labels)
+            lookups.setdefault(labels['cache'], {})[labels['result']] = value
+        for cache, results in sorted(lookups.items()):
+            hits, misses = results.get('hit', 0), results.get('miss', 0)
+            caches.add_row(cache, str(hits), str(misses), f'{hits / (hits + misses):.0%}')
+
+        timings = Table(title='Render and polls', title_justify='left', header_style='dark_orange')
+        for column in ('stage', 'count', 'p50 ms', 'p95 ms', 'max ms'):
+            timings.add_column(column, justify='left' if column == 'stage' else 'right')
+        stages = [(dict(labels)['stage'], histogram) for labels, histogram
+                  in sorted(self.metrics.histogram_values('render_stage_seconds').items())]
+        for name in ('poll_lag_seconds', 'poll_seconds', 'preview_render_seconds'):
+            stages += [(name[:-len('_seconds')].replace('_', ' '), histogram)
+                       for histogram in self.metrics.histogram_values(name).values()]
+        for stage, histogram in stages:
+            timings.add_row(stage, str(histogram.count), ms(histogram.quantile(0.5)),
+                            ms(histogram.quantile(0.95)), ms(histogram.max))
+
+        self.console.print(requests, caches, timings)
+
+    def parse_channel(self, text):
+        """
+        The `parse_channel` function finds the channel a :watch: or :search: command
+        is about.
+
+        :param text: A local ID from :li, dm:<local ID> from :dm, #channel or @friend,
+        here for the current channel, or a channel ID.
+        :return: the channel ID, None if there is no such channel.
+        """
+
+        text = text.strip()
+        if text == 'here':
+            return self.args.channel
+        if text.startswith(('#', '@')):
+            return next((channel for channel, name in self.channel_names.items()
+                         if name == text), None)
+        try:
+            if text.startswith('dm:'):
+                index = int(text[3:]) - 1
+                return self.friends[index]['id'] if index >= 0 else None
+            if int(text) in self.list_id:
+                return self.list_id[int(text)]
+        except (ValueError, IndexError):
+            return None
+
+        # Snowflakes are at least 17 digits long
+        return text if len(text) >= 17 else None
+
+    def search_messages(self, query):
+        """
+        The `search_messages` function searches the archived messages (:search:).
+
+        :param query: Words and filters, see `parse_search`.
+        :return: the matching messages, oldest first.
+        :raise ValueError: if a filter is invalid.
+        """
+
+        words, filters = parse_search(query)
+
+        channel = filters.get('in')
+        if channel is not None:
+            channel = self.parse_channel(channel)
+            if channel is None:
+                raise ValueError(f'Unknown channel {filters["in"]}')
+        for date in ('after', 'before'):
+            if date in filters:
+                try:
+                    date_snowflake(filters[date])
+                except ValueError:
+                    raise ValueError(f'Invalid date {filters[date]}, expected YYYY-MM-DD') from None
+
+        results = self.archive.search(
+            words,
+            channel=channel,
+            author=filters.get('from'),
+            after=filters.get('after'),
+            before=filters.get('before'),
+            limit=SEARCH_RESULTS
+        )
+
+        return results[::-1]
 
     def print_welcome(self):
         """ Print the welcome message and the commands list """
-        whoami = self.get_username_from_id(self.user_id)
+        whoami = self.resolve_username(self.user_id)
         rprint('\n[#7289DA]' +
                f'                                           [dark_orange]Available commands: [/dark_orange]\n' +
                f'    [dark_orange]░█▀▀░█░█░█░█░█▀▄░█▀▄░█▀▀░█▀█░█▀▄░█▀▄[/dark_orange]     :li - List Guilds & Channels\n' +
@@ -742,33 +1748,186 @@ class MyClient():
                f'          Logged in as: [dark_orange]{whoami}[/dark_orange]           :q  - Exit chubbcord\n[/#7289DA]'
                )
 
-    def main_loop(self):
+    def is_watched(self, channel):
         """
-        The main_loop function retrieves and prints messages, then continuously checks for new
-        messages and prints any differences.
+        :param channel: Channel ID.
+        :return: True if the messages of the channel are printed (current or watched channel).
         """
 
-        self.messages = self.get_messages()
-        self.print_messages(self.messages)
-        self.kill_thread = False
-        self.running = True
+        return self.running and (channel == self.args.channel or channel in self.watched)
+
+    def focus_channel(self, channel):
+        """
+        The focus_channel function makes `channel` the current channel: its last messages
+        are printed, messages are sent to it, and it is polled along the watched channels.
 
-        started = time.time()
-        while not self.kill_thread:
-            if time.time() - started >= 3:
-                new_messages = self.get_messages()
-                diff_messages = self.diff_messages(new_messages, self.messages)
-                self.print_messages(diff_messages)
-                self.messages = new_messages
-                started = time.time()
+        :param channel: Channel ID.
+        """
+
+        with self.store_lock:
+            previous = self.args.channel
+            self.args.channel = channel
+            self.running = True
+            if previous and previous != channel and previous not in self.watched:
+                self.scheduler.unwatch(previous)
+        self.refresh_screen()
+        self.scheduler.watch(channel)
+        self.scheduler.bump(channel)
+
+    def poll_channel(self, channel):
+        """
+        The poll_channel function is called by the scheduler, in turn for every watched
+        channel, and prints what changed in it.
+
+        :param channel: Channel ID.
+        :return: True if something changed, False if not, None if the channel wasn't
+        polled (the scheduler keeps its interval).
+        """
+
+        # With a live gateway session, messages are pushed by on_gateway_event and
+        # the channel backs off to the slowest interval
+        if self.gateway and self.gateway.connected:
+            return False
+
+        with self.store_lock:
+            if not self.is_watched(channel):
+                return None
+            first = self.get_store(channel).newest_id is None and channel != self.args.channel
+        # Messages posted before the channel was watched are not news
+        if first:
+            self.reset_messages(channel)
+            return None
+
+        return bool(self.catch_up(channel))
+
+    def catch_up(self, channel):
+        """
+        The catch_up function polls a channel and prints what changed in it. The stores
+        are not locked while waiting for Discord, so sending and printing never wait
+        for a poll.
+
+        :param channel: Channel ID.
+        :return: the `MessageDelta` of the poll.
+        """
+
+        delta = self.poll_messages(channel)
+        with self.store_lock:
+            if self.is_watched(channel):
+                self.print_messages(self.reconcile(delta))
+
+        return delta
+
+    def on_gateway_event(self, event, data):
+        """
+        The on_gateway_event function receives the events dispatched by the gateway and
+        prints the ones about the current and watched channels.
+
+        :param event: Name of the event (MESSAGE_CREATE, MESSAGE_UPDATE...).
+        :param data: Data of the event.
+        """
+
+        if event in ('MESSAGE_CREATE', 'MESSAGE_UPDATE'):
+            self.harvest_identities([data])
+
+        if event == 'READY':
+            # New session: events sent while disconnected were lost
+            for channel in self.scheduler.channels:
+                with self.store_lock:
+                    if not self.running or self.get_store(channel).newest_id is None:
+                        continue
+                self.catch_up(channel)
+            return
+
+        with self.store_lock:
+            if not self.running or not self.is_watched(data.get('channel_id')):
+                return
+
+            store = self.get_store(data['channel_id'])
+            if event == 'MESSAGE_CREATE':
+                message = Message.from_json(data)
+                newest_id = store.newest_id
+                delta = store.merge([message])
+                # Events arrive in order, nothing is missing since the newest message
+                self.archive.store(
+                    data['channel_id'], [message],
+                    (int(newest_id), int(data['id'])) if newest_id and delta else None
+                )
+            elif event == 'MESSAGE_UPDATE':
+                delta = store.update(data)
+                self.archive.store(data['channel_id'], delta.edited)
+            elif event == 'MESSAGE_DELETE':
+                message = store.remove(data['id'])
+                self.archive.delete(data['channel_id'], [data['id']])
+                delta = MessageDelta(deleted=[message] if message else [])
             else:
-                time.sleep(0.1)
+                return
 
-    def clean(self):
-        """ Clean the .chubbcord folder """
+            self.print_messages(self.reconcile(delta))
+
+    def start_gateway(self):
+        """ Connect to the gateway in the background, to receive messages in real time """
+
+        self.gateway = Gateway(
+            self.http.token,
+            self.on_gateway_event,
+            user_agent=self.http.session.headers['User-Agent'],
+            on_error=self.on_gateway_error,
+            on_disconnect=self.on_gateway_disconnect
+        )
+        self.gateway.start()
+
+    def on_gateway_error(self, event, error):
+        """
+        The on_gateway_error function reports an event that couldn't be handled (the
+        gateway session goes on), and counts it for the metrics.
+
+        :param event: Name of the event.
+        :param error: The exception raised while handling it.
+        """
+
+        self.metrics.inc('gateway_errors_total', event=event)
+        self.warn(f'Gateway {event} failed : {error!r}')
+
+    def on_poll_error(self, channel, error):
+        """
+        The on_poll_error function reports a poll that failed for another reason than
+        the network (the channel is polled again at its next turn), and counts it for
+        the metrics.
+
+        :param channel: Channel ID.
+        :param error: The exception raised while polling it.
+        """
+
+        self.metrics.inc('poll_errors_total')
+        self.warn(f'Polling {self.channel_label(channel)} failed : {error!r}')
+
+    def on_gateway_disconnect(self):
+        """
+        The on_gateway_disconnect function brings the polls back while the gateway
+        reconnects: connected, they backed off to the slowest interval.
+        """
 
-        for file in os.listdir(f'{confdir}/tmp'):
-            os.remove(f'{confdir}/tmp/{file}')
+        for channel in self.scheduler.channels:
+            self.scheduler.bump(channel)
+
+    def clean(self):
+        """ Clean the .chubbcord folder (attachments past the cache quota) and
+        stop the background workers """
+
+        if not self.outbox.join(SEND_DRAIN_TIMEOUT):
+            self.warn('Some messages could not be sent')
+        self.outbox.close()
+        self.scheduler.stop()
+        if self.exporter:
+            self.exporter.stop()
+        self.attachment_cache.close()
+        self.previews.close()
+        if self.gateway:
+            self.gateway.stop()
+        self.archive.close()
+        self.lookup_pool.shutdown(wait=False, cancel_futures=True)
+        self.ids.save()
+        self.http.close()
 
     def main(self):
         """
@@ -776,19 +1935,32 @@ class MyClient():
         message.
         """
 
-        os.system(f'termtitle "chubbcord: a discord client -- {self.get_username_from_id(self.user_id)}"')
-
         self.print_welcome()
 
+        os.system(f'termtitle "chubbcord: a discord client -- {self.resolve_username(self.user_id)}"')
+
+        if self.args.gateway:
+            self.start_gateway()
+
         self.running = False
-        self.list_id = {}
+        for channel in self.watched:
+            self.scheduler.watch(channel, now=True)
+        self.scheduler.start()
 
         def query_data():
-            """ Query data from Discord API in a thread """
-            self.list_friends()
-            self.rprint_friends()
-            self.list_guilds()
-            self.rprint_guilds()
+            """ Query data from Discord API in a thread, then save the snapshot """
+            try:
+                self.list_friends()
+                self.rprint_friends()
+                futures = self.list_guilds()
+            finally:
+                self.directory_ready.set()
+            wait(futures)
+            self.directory.save(self.friends, self.guilds)
+
+        # The last snapshot is served right away, and refreshed in the background
+        if self.load_directory():
+            self.directory_ready.set()
 
         def loading_bar(symbol):
             """ Simple loading bar while we fetch the datas from the API
@@ -803,45 +1975,37 @@ class MyClient():
         query_data_thread.start()
 
         symbol = ' '
-        while query_data_thread.is_alive():
+        while not self.directory_ready.is_set():
             symbol = loading_bar(symbol)
             print(f' Loading... {loading_bar(symbol)}', end='\r')
-            time.sleep(0.1)
-
-        for guild in self.guilds:
-            for channel in guild['channels']:
-                self.list_id[channel['local_id']] = channel['id']
+            self.directory_ready.wait(0.1)
 
         if not self.args.channel:
             while self.args.channel is None:
                 try:
                     with patch_stdout(raw=True):
                         command = prompt(' READY >> ')
-                    if command == ':cr' or ':attach' in command:
+                    if command in (':cr', ':up') or ':attach' in command or command.startswith(':dl'):
                         print('Please, select a channel first')
                     else:
                         self.internal_command(command)
                 except KeyboardInterrupt:
-                    if self.running:
-                        self.kill_thread = True
-                        self.main_loop_thread.join()
                     self.clean()
                     sys.exit()
 
         else:
-            self.main_loop_thread = threading.Thread(target=self.main_loop)
-            self.main_loop_thread.start()
-            self.refresh_screen()
+            self.focus_channel(self.args.channel)
 
-        commands_list = [':q', ':help', ':cr', ':li', ':dm', ':we']
+        commands_list = [':q', ':help', ':cr', ':li', ':dm', ':we', ':dl', ':watch', ':up', ':stats']
 
         while 1:
             try:
-                time.sleep(1)
                 with patch_stdout(raw=True):
                     content = prompt(' >> ', wrap_lines=False, multiline=False)
-                if content != '' and ':attach' not in content and content not in commands_list:
-                    message_sent = self.send_message(content)
+                if content != '' and ':attach' not in content and not content.startswith(':dl:') \
+                        and not content.startswith((':watch:', ':unwatch:', ':search:')) \
+                        and content not in commands_list:
+                    self.queue_message(content)
                 if content == '':
                     self.refresh_screen()
                     self.internal_command(content)
@@ -849,9 +2013,6 @@ class MyClient():
                     self.internal_command(content)
 
             except KeyboardInterrupt:
-                if self.running:
-                    self.kill_thread = True
-                    self.main_loop_thread.join()
                 self.clean()
                 sys.exit()
 
@@ -859,7 +2020,12 @@ class MyClient():
 def main():
     """ This main function is used to make an entry point for the program."""
 
-    client = MyClient()
+    if parse_args().headless:
+        # Imported here, headless.py builds on this module
+        from .headless import HeadlessClient
+        client = HeadlessClient()
+    else:
+        client = MyClient()
     client.main()
 
 
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# metrics.py - Counters and histograms of requests, caches and rendering.
+# --------------------------------------------------
+# Built-in
+import threading
+import time
+from contextlib import contextmanager
+
+from .files import write_atomic
+
+# Upper bounds (seconds) of the histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+RENDER_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+
+PREFIX = 'chubbcord_'
+
+
+def label_key(name, labels):
+    """ :return: the key of a metric, its labels sorted and as strings. """
+
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+class Histogram():
+    """ Observations counted in fixed buckets, like a Prometheus histogram """
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        :param q: The quantile (0.5 for the median).
+        :return: the upper bound of the bucket holding the quantile, at most the
+        largest observation.
+        """
+
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.buckets[index], self.max) if index < len(self.buckets) else self.max
+        return 0.0
+
+
+class Metrics():
+    """
+    Registry of the counters and histograms of a session, safe to update from
+    any thread. Every metric is identified by its name and its labels.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        """ Add `amount` to a counter """
+
+        key = label_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """ Count an observation (seconds) in a histogram """
+
+        key = label_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, buckets=LATENCY_BUCKETS, **labels):
+        """ Observe the time spent in a `with` block """
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, buckets, **labels)
+
+    def counter_values(self, name):
+        """ :return: a {labels dict as tuple: value} map of a counter. """
+
+        with self.lock:
+            return {labels: value for (metric, labels), value in self.counters.items()
+                    if metric == name}
+
+    def histogram_values(self, name):
+        """ :return: a {labels dict as tuple: Histogram} map of a histogram. """
+
+        with self.lock:
+            return {labels: histogram for (metric, labels), histogram in self.histograms.items()
+                    if metric == name}
+
+    def prometheus(self):
+        """ :return: every metric in the Prometheus text exposition format. """
+
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        def format_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ''
+            return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f'# TYPE {PREFIX}{name} counter')
+                typed.add(name)
+            lines.append(f'{PREFIX}{name}{format_labels(labels)} {value}')
+
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append(f'# TYPE {PREFIX}{name} histogram')
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f'{PREFIX}{name}_bucket{format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{PREFIX}{name}_sum{format_labels(labels)} {histogram.sum}')
+            lines.append(f'{PREFIX}{name}_count{format_labels(labels)} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        """ Write the metrics to a file atomically (for the node exporter textfile collector) """
+
+        write_atomic(path, self.prometheus())
+
+
+class MetricsExporter():
+    """ Write the metrics to a file every `interval` seconds, from a thread """
+
+    def __init__(self, metrics, path, interval=15):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.metrics.export(self.path)
+
+    def stop(self):
+        """ Stop the thread and write the final metrics """
+
+        self.stopped.set()
+        self.metrics.export(self.path)
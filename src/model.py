@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# model.py - Compact messages and attachments, built from the Discord JSON.
+# --------------------------------------------------
+# Built-in
+import sys
+
+
+def shared(text):
+    """ :return: the text, as the one copy shared by every message (IDs, names). """
+
+    return sys.intern(text) if isinstance(text, str) else text
+
+
+class Attachment():
+    """ An attachment of a message, with the fields chubbcord lists, previews and downloads """
+
+    __slots__ = ('id', 'filename', 'url', 'proxy_url', 'size', 'content_type', 'width', 'height')
+
+    def __init__(self, id, filename, url, proxy_url=None, size=None, content_type=None,
+                 width=None, height=None):
+        self.id = id
+        self.filename = filename
+        self.url = url
+        self.proxy_url = proxy_url
+        self.size = size
+        self.content_type = content_type
+        self.width = width
+        self.height = height
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        :param data: Attachment object from the Discord API.
+        :return: the `Attachment`.
+        """
+
+        return cls(
+            data['id'], data['filename'], data['url'], data.get('proxy_url'), data.get('size'),
+            shared(data.get('content_type')), data.get('width'), data.get('height')
+        )
+
+    def to_json(self):
+        """ :return: the attachment as an attachment object of the Discord API. """
+
+        return {name: getattr(self, name) for name in self.__slots__
+                if getattr(self, name) is not None}
+
+
+class Message():
+    """
+    A message, with only the fields chubbcord prints, searches and reconciles.
+
+    Discord sends about thirty fields per message (embeds, components, flags, the
+    whole profile of the author...): the others are dropped as the message is
+    built, and the IDs and names repeated from a message to the other are shared.
+    """
+
+    __slots__ = ('id', 'channel_id', 'author_id', 'username', 'global_name', 'timestamp',
+                 'edited_timestamp', 'content', 'attachments', 'referenced', 'nonce')
+
+    def __init__(self, id, channel_id, author_id, username, global_name=None, timestamp='',
+                 edited_timestamp=None, content='', attachments=(), referenced=None, nonce=None):
+        """
+        :param referenced: The `Message` replied to, `DELETED` if it was deleted, None
+        if the message is not a reply.
+        """
+
+        self.id = id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.username = username
+        self.global_name = global_name
+        self.timestamp = timestamp
+        self.edited_timestamp = edited_timestamp
+        self.content = content
+        self.attachments = attachments
+        self.referenced = referenced
+        self.nonce = nonce
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        :param data: Message object from the Discord API (or from the archive).
+        :return: the `Message`.
+        """
+
+        author = data.get('author') or {}
+        if 'referenced_message' not in data:
+            referenced = None
+        elif data['referenced_message'] is None:
+            referenced = DELETED
+        else:
+            referenced = cls.from_json(data['referenced_message'])
+
+        return cls(
+            data['id'],
+            shared(data.get('channel_id')),
+            shared(author.get('id')),
+            shared(author.get('username')),
+            shared(author.get('global_name')),
+            data.get('timestamp') or '',
+            data.get('edited_timestamp'),
+            data.get('content') or '',
+            tuple(Attachment.from_json(attachment) for attachment in data.get('attachments') or ()),
+            referenced,
+            data.get('nonce'),
+        )
+
+    def to_json(self):
+        """ :return: the message as a message object of the Discord API (for the archive). """
+
+        data = {
+            'id': self.id,
+            'channel_id': self.channel_id,
+            'author': {'id': self.author_id, 'username': self.username,
+                       'global_name': self.global_name},
+            'timestamp': self.timestamp,
+            'edited_timestamp': self.edited_timestamp,
+            'content': self.content,
+            'attachments': [attachment.to_json() for attachment in self.attachments],
+        }
+        if self.referenced is DELETED:
+            data['referenced_message'] = None
+        elif self.referenced is not None:
+            data['referenced_message'] = self.referenced.to_json()
+        if self.nonce is not None:
+            data['nonce'] = self.nonce
+
+        return data
+
+    def updated(self, data):
+        """
+        :param data: Partial message object (gateway MESSAGE_UPDATE).
+        :return: a new `Message`, with the fields of `data` applied.
+        """
+
+        return Message.from_json({**self.to_json(), **data})
+
+    @property
+    def author_name(self):
+        """ Name the author is shown by """
+
+        return self.global_name or self.username
+
+    def __repr__(self):
+        return f'Message(id={self.id}, channel_id={self.channel_id}, author={self.author_name})'
+
+
+# The message a reply refers to, once deleted
+DELETED = Message(id=None, channel_id=None, author_id=None, username=None)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# outbox.py - Messages sent in the background, in order, with retries.
+# --------------------------------------------------
+# Built-in
+import itertools
+import queue
+import threading
+import time
+
+from .archive import DISCORD_EPOCH
+from .transport import TransportError
+
+nonce_sequence = itertools.count()
+
+
+def new_nonce():
+    """
+    :return: a nonce for a message to send, shaped like a snowflake of the current
+    time (Discord only accepts integers, or strings of 25 characters at most).
+    """
+
+    return str(((int(time.time() * 1000) - DISCORD_EPOCH) << 22) | (next(nonce_sequence) & 0x3FFFFF))
+
+
+def transient(error):
+    """
+    :param error: A `TransportError`.
+    :return: True if sending again may work: network errors, server errors, and
+    429s still rate limited after the transport retries.
+    """
+
+    status = error.status_code
+    return status is None or status == 429 or status >= 500
+
+
+class Outbox():
+    """
+    Messages waiting to be sent. Every channel has its own queue and thread: the
+    messages of a channel are sent in order, channels are sent to in parallel, and
+    whoever queues a message never waits for Discord.
+
+    A message failing with a transient error is sent again after 1, 2, 4... seconds.
+    Every message carries a nonce Discord enforces, so sending it again can't post
+    it twice.
+    """
+
+    def __init__(self, send, on_sent=None, on_failed=None, retries=4, backoff=1, max_backoff=30):
+        """
+        :param send: Function sending a message, called as send(content, channel=...,
+        nonce=...), returning the message posted and raising `TransportError`.
+        :param on_sent: Called with (channel, nonce, message) once a message is posted.
+        :param on_failed: Called with (channel, nonce, content, error) when a message
+        is given up on.
+        :param retries: Times a message is sent again after a transient error.
+        :param backoff: Seconds before the first retry, doubled for every next one.
+        :param max_backoff: Seconds between two retries, at most.
+        """
+
+        self.send = send
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.queues = {}
+        self.unsent = 0
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+
+    def put(self, channel, content, nonce=None):
+        """
+        Queue a message.
+
+        :param channel: Channel ID.
+        :param content: Content of the message.
+        :param nonce: Nonce of the message, a new one if None.
+        :return: the nonce of the message.
+        """
+
+        nonce = nonce or new_nonce()
+        with self.condition:
+            self.unsent += 1
+            outbox = self.queues.get(channel)
+            if outbox is None:
+                outbox = self.queues[channel] = queue.Queue()
+                threading.Thread(target=self.worker, args=(channel, outbox), daemon=True).start()
+        outbox.put((content, nonce))
+
+        return nonce
+
+    def worker(self, channel, outbox):
+        """ Thread sending the queued messages of a channel, one at a time """
+
+        while True:
+            content, nonce = outbox.get()
+            try:
+                self.deliver(channel, content, nonce)
+            finally:
+                with self.condition:
+                    self.unsent -= 1
+                    self.condition.notify_all()
+
+    def deliver(self, channel, content, nonce):
+        """ Send a message, retrying it after transient errors """
+
+        for attempt in range(self.retries + 1):
+            try:
+                message = self.send(content, channel=channel, nonce=nonce)
+            except TransportError as error:
+                delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+                if attempt == self.retries or not transient(error) or self.stopped.wait(delay):
+                    if self.on_failed:
+                        self.on_failed(channel, nonce, content, error)
+                    return
+                continue
+
+            if self.on_sent:
+                self.on_sent(channel, nonce, message)
+            return
+
+    def join(self, timeout=None):
+        """
+        Wait for every queued message to be sent (or given up on).
+
+        :param timeout: Seconds to wait at most, None to wait as long as needed.
+        :return: True if nothing is left to send.
+        """
+
+        with self.condition:
+            return self.condition.wait_for(lambda: self.unsent == 0, timeout)
+
+    def close(self):
+        """ Stop retrying: messages waiting for a retry are given up on """
+
+        self.stopped.set()
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# preview.py - Terminal previews of attachments, rendered by chafa.
+# --------------------------------------------------
+# Built-in
+import hashlib
+import os
+import re
+import shutil
+import subprocess as sp
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Largest preview, in terminal cells
+PREVIEW_COLUMNS = 80
+PREVIEW_LINES = 25
+
+# Files of the attachment cache are named after the SHA-256 of their content
+CONTENT_ADDRESSED = re.compile(r'[0-9a-f]{64}')
+
+
+class PreviewRenderer():
+    """
+    Render attachments to ANSI art with chafa on a pool of workers.
+
+    chafa is detected once per session, and rendered previews are kept in a LRU
+    cache keyed by (file content hash, preview size, terminal geometry).
+    """
+
+    def __init__(self, workers=2, capacity=128, metrics=None):
+        """
+        :param workers: Previews rendered at the same time.
+        :param capacity: Rendered previews kept in memory.
+        :param metrics: `Metrics` chafa runs are timed in.
+        """
+
+        self.capacity = capacity
+        self.metrics = metrics
+        self.renders = OrderedDict()
+        self.hashes = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self._available = None
+
+    @property
+    def available(self):
+        """ True if chafa can be used, detected on first use only """
+
+        if self._available is None:
+            available = False
+            if os.name == 'posix' and shutil.which('chafa'):
+                try:
+                    available = 'Chafa version' in sp.run(
+                        ['chafa', '--version'], capture_output=True, text=True, timeout=5
+                    ).stdout
+                except (OSError, sp.SubprocessError):
+                    pass
+            self._available = available
+
+        return self._available
+
+    def geometry(self):
+        """ :return: the (columns, lines) of the preview and of the terminal. """
+
+        terminal = shutil.get_terminal_size()
+        return (min(PREVIEW_COLUMNS, terminal.columns), PREVIEW_LINES,
+                terminal.columns, terminal.lines)
+
+    def content_hash(self, path):
+        """
+        :param path: Path of a file.
+        :return: the SHA-256 of the file: taken from its name for the files of the
+        attachment cache, else computed and memoized by (path, size, modification time).
+        """
+
+        name = os.path.splitext(os.path.basename(path))[0]
+        if CONTENT_ADDRESSED.fullmatch(name):
+            return name
+
+        stat = os.stat(path)
+        signature = (path, stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if signature in self.hashes:
+                return self.hashes[signature]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+
+        with self.lock:
+            if len(self.hashes) >= self.capacity * 4:
+                self.hashes.clear()
+            self.hashes[signature] = digest.hexdigest()
+            return self.hashes[signature]
+
+    def key(self, path):
+        return (self.content_hash(path),) + self.geometry()
+
+    def cached(self, path):
+        """
+        :param path: Path of the attachment.
+        :return: the rendered preview of the attachment, None if not rendered yet.
+        """
+
+        try:
+            key = self.key(path)
+        except OSError:
+            return None
+
+        return self.lookup(key)
+
+    def lookup(self, key):
+        """ :return: the rendered preview of a key, None if not rendered yet. """
+
+        with self.lock:
+            render = self.renders.get(key)
+            if render is not None:
+                self.renders.move_to_end(key)
+            return render
+
+    def render(self, path):
+        """
+        Render an attachment with chafa, or fetch it from the cache.
+
+        :param path: Path of the attachment.
+        :return: the ANSI preview (empty if chafa failed).
+        """
+
+        key = self.key(path)
+        render = self.lookup(key)
+        if render is not None:
+            return render
+
+        columns, lines = key[1], key[2]
+        started = time.perf_counter()
+        try:
+            render = sp.run(
+                ['chafa', path, f'--size={columns}x{lines}', '--animate=off'],
+                capture_output=True, text=True, timeout=30
+            ).stdout
+        except (OSError, sp.SubprocessError):
+            render = ''
+        if self.metrics is not None:
+            self.metrics.observe('preview_render_seconds', time.perf_counter() - started)
+
+        with self.lock:
+            self.renders[key] = render
+            while len(self.renders) > self.capacity:
+                self.renders.popitem(last=False)
+
+        return render
+
+    def submit(self, path, on_done):
+        """
+        Render an attachment on a worker.
+
+        :param path: Path of the attachment.
+        :param on_done: Called with the rendered preview.
+        """
+
+        def work():
+            try:
+                render = self.render(path)
+            except OSError:
+                return
+            on_done(render)
+
+        self.pool.submit(work)
+
+    def close(self):
+        """ Stop the workers """
+
+        self.pool.shutdown(wait=False, cancel_futures=True)
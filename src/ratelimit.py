@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# ratelimit.py - Request scheduler honoring Discord rate limit buckets.
+# --------------------------------------------------
+# Built-in
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Request priorities: interactive work (sends, active channel poll) always goes
+# before background work (directory loading, username lookups)
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Requests of a bucket left to interactive work once background work used the rest
+BACKGROUND_RESERVE = 1
+
+SNOWFLAKE = re.compile(r'\d{15,21}')
+MAJOR_PARAMETER = re.compile(r'/(channels|guilds|webhooks)/(\d+)')
+
+
+def route_key(method, url):
+    """
+    Key of the rate limit route of a request.
+
+    Discord shares a bucket between requests of the same route, but counts it
+    separately for each major parameter (channel, guild or webhook ID).
+
+    :param method: HTTP method of the request.
+    :param url: Absolute URL of the request.
+    :return: a (method, host + generic path, major parameter) tuple.
+    """
+
+    parts = urlsplit(url)
+    major = MAJOR_PARAMETER.search(parts.path)
+
+    return (
+        method,
+        parts.netloc + SNOWFLAKE.sub('{id}', parts.path),
+        major.group(2) if major else None
+    )
+
+
+def retry_after(response):
+    """
+    Time to wait before retrying a rate limited request.
+
+    :param response: The 429 `requests.Response`.
+    :return: the delay in seconds.
+    """
+
+    try:
+        return float(response.json()['retry_after'])
+    except (ValueError, KeyError, TypeError):
+        return float(response.headers.get('Retry-After', 1))
+
+
+class Bucket():
+    """ What is known of a rate limit bucket """
+
+    __slots__ = ('remaining', 'reset_at')
+
+    def __init__(self):
+        # None until Discord told us (or once the bucket was reset)
+        self.remaining = None
+        self.reset_at = 0
+
+
+class RateLimiter():
+    """
+    Queue requests so they wait for their bucket instead of getting a 429.
+
+    Buckets are learnt from the `X-RateLimit-*` headers of every response, and
+    background requests wait as long as an interactive one is queued.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.routes = {}
+        self.buckets = {}
+        self.global_reset_at = 0
+        self.interactive_waiting = 0
+
+    def bucket(self, key):
+        """ Return the bucket of a route key, creating it on first use """
+
+        method, route, major = key
+        bucket_id = (self.routes.get((method, route), (method, route)), major)
+        if bucket_id not in self.buckets:
+            self.buckets[bucket_id] = Bucket()
+
+        return self.buckets[bucket_id]
+
+    def delay(self, key, priority, now):
+        """
+        Time a request must still wait before being sent.
+
+        :return: the delay in seconds, 0 to send it now, None to wait for a
+        notification (an interactive request is queued).
+        """
+
+        if self.global_reset_at > now:
+            return self.global_reset_at - now
+
+        bucket = self.bucket(key)
+        if bucket.reset_at <= now:
+            bucket.remaining = None
+        elif bucket.remaining is not None and bucket.remaining <= 0:
+            return bucket.reset_at - now
+
+        if priority == BACKGROUND:
+            if self.interactive_waiting:
+                return None
+            if bucket.remaining is not None and bucket.remaining <= BACKGROUND_RESERVE:
+                return bucket.reset_at - now
+
+        return 0
+
+    def acquire(self, key, priority=INTERACTIVE):
+        """
+        Block until a request on this route can be sent.
+
+        :param key: Route key of the request (see `route_key`).
+        :param priority: INTERACTIVE or BACKGROUND.
+        """
+
+        with self.condition:
+            if priority == INTERACTIVE:
+                self.interactive_waiting += 1
+            try:
+                while True:
+                    wait = self.delay(key, priority, time.monotonic())
+                    if wait == 0:
+                        break
+                    self.condition.wait(wait)
+
+                bucket = self.bucket(key)
+                if bucket.remaining is not None:
+                    bucket.remaining -= 1
+            finally:
+                if priority == INTERACTIVE:
+                    self.interactive_waiting -= 1
+                    self.condition.notify_all()
+
+    def update(self, key, response):
+        """
+        Learn the state of a bucket from a response.
+
+        :param key: Route key of the request.
+        :param response: The `requests.Response`.
+        """
+
+        headers = response.headers
+        now = time.monotonic()
+
+        with self.condition:
+            method, route, _ = key
+            if 'X-RateLimit-Bucket' in headers:
+                self.routes[(method, route)] = headers['X-RateLimit-Bucket']
+            bucket = self.bucket(key)
+
+            if 'X-RateLimit-Remaining' in headers:
+                bucket.remaining = int(headers['X-RateLimit-Remaining'])
+            if 'X-RateLimit-Reset-After' in headers:
+                bucket.reset_at = now + float(headers['X-RateLimit-Reset-After'])
+
+            if response.status_code == 429:
+                delay = retry_after(response)
+                if headers.get('X-RateLimit-Global') or headers.get('X-RateLimit-Scope') == 'global':
+                    self.global_reset_at = now + delay
+                else:
+                    bucket.remaining = 0
+                    bucket.reset_at = now + delay
+
+            self.condition.notify_all()
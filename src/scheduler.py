@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# scheduler.py - Single thread polling every watched channel.
+# --------------------------------------------------
+# Built-in
+import threading
+import time
+
+from .transport import TransportError
+
+
+class PollScheduler():
+    """
+    Poll a set of channels from a single thread.
+
+    Every channel has its own interval: back to `floor` after activity, doubled
+    after every idle poll up to `ceiling`. Polls are never closer than 1/`budget`
+    second: watching more channels stretches their interval instead of
+    multiplying the request rate.
+    """
+
+    def __init__(self, poll, floor=1, ceiling=30, budget=2, backoff=2, metrics=None,
+                 on_error=None):
+        """
+        :param poll: Called with a channel ID to poll it. Returns True if something
+        happened in the channel, False if not, None to keep its interval as is.
+        :param floor: Shortest interval (seconds) between two polls of a channel.
+        :param ceiling: Longest interval (seconds) between two polls of a channel.
+        :param budget: Polls per second shared by all the channels.
+        :param backoff: Factor the interval of an idle channel grows by.
+        :param metrics: `Metrics` the lag and duration of the polls are timed in.
+        :param on_error: Called with the channel ID and the exception when `poll`
+        raises something else than a `TransportError` (the other channels go on).
+        """
+
+        self.poll = poll
+        self.floor = floor
+        self.ceiling = max(ceiling, floor)
+        self.budget = budget
+        self.backoff = backoff
+        self.metrics = metrics
+        self.on_error = on_error
+
+        self.due = {}
+        self.intervals = {}
+        self.last_poll = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = None
+
+    @property
+    def channels(self):
+        with self.condition:
+            return list(self.due)
+
+    def watch(self, channel, now=False):
+        """
+        Start polling a channel.
+
+        :param channel: Channel ID.
+        :param now: Poll it as soon as the budget allows, instead of in `floor`.
+        """
+
+        with self.condition:
+            if channel not in self.due or now:
+                self.intervals[channel] = self.floor
+                self.due[channel] = time.monotonic() + (0 if now else self.floor)
+                self.condition.notify()
+
+    def unwatch(self, channel):
+        """ Stop polling a channel """
+
+        with self.condition:
+            self.due.pop(channel, None)
+            self.intervals.pop(channel, None)
+            self.condition.notify()
+
+    def bump(self, channel):
+        """ Something is going on in a channel (message sent...): poll it within `floor` """
+
+        with self.condition:
+            if channel in self.due:
+                self.intervals[channel] = self.floor
+                self.due[channel] = min(self.due[channel], time.monotonic() + self.floor)
+                self.condition.notify()
+
+    def interval(self, channel):
+        """ :return: the current interval (seconds) of a channel, None if not watched. """
+
+        with self.condition:
+            return self.intervals.get(channel)
+
+    def start(self):
+        """ Start polling in a thread """
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop polling and wait for the thread """
+
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread:
+            self.thread.join(timeout=5)
+
+    def next_channel(self):
+        """
+        Wait until a channel is due and the budget allows a poll.
+
+        :return: the channel ID to poll and how late (seconds) it is polled, None
+        once stopped.
+        """
+
+        with self.condition:
+            while not self.stopped:
+                if not self.due:
+                    self.condition.wait()
+                    continue
+
+                channel = min(self.due, key=self.due.get)
+                delay = max(self.due[channel], self.last_poll + 1 / self.budget) - time.monotonic()
+                if delay > 0:
+                    # Woken up early by watch, unwatch, bump or stop
+                    self.condition.wait(delay)
+                    continue
+
+                self.last_poll = time.monotonic()
+                lag = self.last_poll - self.due[channel]
+                self.due[channel] = self.last_poll + self.intervals[channel]
+                return channel, lag
+
+        return None
+
+    def adapt(self, channel, activity):
+        """
+        Set the next poll of a channel from what its last poll found.
+
+        :param channel: Channel ID.
+        :param activity: What `poll` returned.
+        """
+
+        with self.condition:
+            if channel not in self.due or activity is None:
+                return
+            if activity:
+                interval = self.floor
+            else:
+                interval = min(self.intervals[channel] * self.backoff, self.ceiling)
+            self.intervals[channel] = interval
+            self.due[channel] = time.monotonic() + interval
+
+    def run(self):
+        """ Poll the channels as they come due until stopped """
+
+        while True:
+            polled = self.next_channel()
+            if polled is None:
+                return
+            channel, lag = polled
+
+            started = time.perf_counter()
+            try:
+                activity = self.poll(channel)
+            except TransportError:
+                # Polled again at its next turn
+                activity = None
+            except Exception as error:
+                # A rendering error must not stop the polls of every channel
+                activity = None
+                if self.on_error:
+                    self.on_error(channel, error)
+            self.adapt(channel, activity)
+
+            if self.metrics is not None:
+                self.metrics.observe('poll_lag_seconds', lag)
+                self.metrics.observe('poll_seconds', time.perf_counter() - started)
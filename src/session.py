@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# session.py - On-disk cache of the user agent and of the logged in profile.
+# --------------------------------------------------
+# Built-in
+import hashlib
+import json
+import time
+
+from .files import write_atomic
+
+SESSION_VERSION = 1
+
+
+def random_user_agent():
+    """
+    :return: a random browser User-Agent. fake_useragent is slow to import, so it
+    is only imported the first time chubbcord runs.
+    """
+
+    import fake_useragent
+
+    return fake_useragent.UserAgent().random
+
+
+def token_hash(token):
+    """ :return: a digest of the token, the token itself is never written here. """
+
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class SessionSnapshot():
+    """
+    What chubbcord needs before printing anything, kept between runs: the
+    User-Agent it presents, and the /users/@me profile of the last token used.
+
+    The profile is served at startup and validated in the background, so the
+    welcome screen doesn't wait for the network.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: JSON file the snapshot is loaded from and saved to.
+        """
+
+        self.path = path
+        self.user_agent = None
+        self.token_hash = None
+        self.me = None
+
+    def load(self):
+        """
+        Load the snapshot, ignoring a missing, corrupt or outdated file.
+
+        :return: True if a snapshot was loaded.
+        """
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if not isinstance(data, dict) or data.get('version') != SESSION_VERSION:
+            return False
+
+        self.user_agent = data['user_agent']
+        self.token_hash = data['token_hash']
+        self.me = data['me']
+
+        return True
+
+    def profile(self, token):
+        """
+        :param token: Discord token.
+        :return: the cached /users/@me profile of this token, None if unknown.
+        """
+
+        if self.me is None or self.token_hash != token_hash(token):
+            return None
+        return self.me
+
+    def remember(self, token, me):
+        """ Cache the profile of a token, then save the snapshot
+
+        :param token: Discord token.
+        :param me: Its /users/@me profile, None to forget it (ex: token rejected).
+        """
+
+        self.token_hash = token_hash(token) if me is not None else None
+        self.me = {'id': me['id'], 'username': me['username'],
+                   'global_name': me.get('global_name')} if me is not None else None
+        self.save()
+
+    def save(self):
+        """ Write the snapshot to disk """
+
+        data = {
+            'version': SESSION_VERSION,
+            'saved_at': time.time(),
+            'user_agent': self.user_agent,
+            'token_hash': self.token_hash,
+            'me': self.me,
+        }
+
+        write_atomic(self.path, json.dumps(data))
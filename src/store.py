@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# store.py - Per-channel message store indexed by snowflake.
+# --------------------------------------------------
+# Built-in
+import bisect
+
+
+class MessageDelta():
+    """ What changed in a channel after merging a fetch into its `MessageStore` """
+
+    __slots__ = ('inserted', 'edited', 'deleted')
+
+    def __init__(self, inserted=None, edited=None, deleted=None):
+        self.inserted = inserted or []
+        self.edited = edited or []
+        self.deleted = deleted or []
+
+    def __bool__(self):
+        return bool(self.inserted or self.edited or self.deleted)
+
+    def __repr__(self):
+        return (f'MessageDelta(inserted={len(self.inserted)}, '
+                f'edited={len(self.edited)}, deleted={len(self.deleted)})')
+
+
+class MessageStore():
+    """
+    The messages of one channel, keyed and ordered by their snowflake ID.
+
+    Lookups are O(1), insertions O(log n), and only the `limit` newest messages
+    are kept.
+    """
+
+    def __init__(self, limit=200):
+        """
+        :param limit: Maximum number of messages kept in the store.
+        """
+
+        self.limit = limit
+        self.messages = {}
+        self.ids = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, message_id):
+        return int(message_id) in self.messages
+
+    def get(self, message_id):
+        """ Return the stored message with the given ID, or None """
+
+        return self.messages.get(int(message_id))
+
+    def values(self):
+        """ Return the stored messages, oldest first """
+
+        return [self.messages[message_id] for message_id in self.ids]
+
+    @property
+    def newest_id(self):
+        """ ID (str) of the newest stored message, None if the store is empty """
+
+        return str(self.ids[-1]) if self.ids else None
+
+    def merge(self, messages, complete=False):
+        """
+        Merge fetched messages into the store.
+
+        :param messages: List of `Message`.
+        :param complete: True if `messages` is the whole latest window of the channel,
+        so stored messages missing from it (and newer than its oldest one) were deleted.
+        :return: a `MessageDelta` with the inserted, edited and deleted messages.
+        """
+
+        delta = MessageDelta()
+        fetched = set()
+
+        for message in sorted(messages, key=lambda message: int(message.id)):
+            message_id = int(message.id)
+            fetched.add(message_id)
+            old = self.messages.get(message_id)
+
+            if old is None:
+                bisect.insort(self.ids, message_id)
+                delta.inserted.append(message)
+            elif old.edited_timestamp != message.edited_timestamp:
+                delta.edited.append(message)
+            self.messages[message_id] = message
+
+        if complete:
+            oldest = min(fetched) if fetched else 0
+            start = bisect.bisect_left(self.ids, oldest)
+            for message_id in self.ids[start:]:
+                if message_id not in fetched:
+                    delta.deleted.append(self.messages[message_id])
+            for message in delta.deleted:
+                self.remove(message.id)
+
+        self.evict()
+
+        return delta
+
+    def update(self, message):
+        """
+        Apply a partial message (gateway MESSAGE_UPDATE) to a stored message.
+
+        :param message: Partial message object, with at least its `id`.
+        :return: a `MessageDelta`, with the message as edited if its
+        `edited_timestamp` changed.
+        """
+
+        message_id = int(message['id'])
+        old = self.messages.get(message_id)
+        if old is None:
+            return MessageDelta()
+
+        new = old.updated(message)
+        self.messages[message_id] = new
+        if new.edited_timestamp != old.edited_timestamp:
+            return MessageDelta(edited=[new])
+
+        return MessageDelta()
+
+    def remove(self, message_id):
+        """
+        Remove a message from the store.
+
+        :return: the removed message, or None if it was not stored.
+        """
+
+        message_id = int(message_id)
+        message = self.messages.pop(message_id, None)
+        if message is not None:
+            del self.ids[bisect.bisect_left(self.ids, message_id)]
+
+        return message
+
+    def evict(self):
+        """ Drop the oldest messages beyond `limit` """
+
+        overflow = len(self.ids) - self.limit
+        if overflow > 0:
+            for message_id in self.ids[:overflow]:
+                del self.messages[message_id]
+            del self.ids[:overflow]
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# transport.py - Pooled HTTP transport used by every chubbcord API call.
+# --------------------------------------------------
+# Built-in
+import time
+from urllib.parse import urlsplit
+
+# 3rd party
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .ratelimit import INTERACTIVE, RateLimiter, route_key
+
+
+# Times a rate limited (429) request is retried before giving up
+RATE_LIMIT_RETRIES = 3
+
+
+class TransportError(Exception):
+    """ Raised when a request fails or answers with an unexpected status code.
+
+    The message keeps the historical `<action> failed : <status> <text>` format,
+    and the response (if any) is kept in `self.response`.
+    """
+
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
+
+    @property
+    def status_code(self):
+        return self.response.status_code if self.response is not None else None
+
+
+class Transport():
+    """
+    A single `requests.Session` shared by every API call of a `MyClient`.
+
+    Connections are kept alive and pooled per host, default headers and timeout
+    are set once, every request waits for its rate limit bucket, and every failure
+    is surfaced as a `TransportError`.
+    """
+
+    def __init__(self, base_url, user_agent, token=None, timeout=5, pool_size=10, metrics=None):
+        """
+        :param base_url: Root of the Discord API (ex: https://discord.com/api/v9).
+        :param user_agent: User-Agent sent with every request.
+        :param token: Discord token, only sent to `base_url`.
+        :param timeout: Default timeout (seconds) of every request.
+        :param pool_size: Number of keep-alive connections kept per host.
+        :param metrics: `Metrics` the requests are counted and timed in.
+        """
+
+        self.base_url = base_url
+        self.token = token
+        self.timeout = timeout
+        self.metrics = metrics
+
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': user_agent})
+
+        # Only connection errors are retried, HTTP statuses are left to the caller
+        # (429s included: urllib3 would otherwise act on their Retry-After header)
+        retries = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.3,
+                        respect_retry_after_header=False)
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=retries
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.limiter = RateLimiter()
+
+    def request(self, method, url, action='Request', expected=(200,),
+                priority=INTERACTIVE, **kwargs):
+        """
+        Send a request through the shared session.
+
+        :param method: HTTP method (GET, POST, PUT...).
+        :param url: Absolute URL, or a route relative to `base_url` if it starts with '/'.
+        :param action: Human readable name of the call, used in error messages.
+        :param expected: Accepted status codes, `None` to accept anything.
+        :param priority: INTERACTIVE or BACKGROUND, see `RateLimiter`.
+        :return: the `requests.Response` object.
+        """
+
+        if url.startswith('/'):
+            url = self.base_url + url
+        if url.startswith(self.base_url) and self.token:
+            headers = kwargs.pop('headers', None) or {}
+            kwargs['headers'] = {'Authorization': self.token, **headers}
+        kwargs.setdefault('timeout', self.timeout)
+        key = route_key(method, url)
+        route = self.route_label(method, url, key)
+
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            waited = time.perf_counter()
+            self.limiter.acquire(key, priority)
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.RequestException as error:
+                self.count(route, 'error', started - waited, time.perf_counter() - started)
+                raise TransportError(f'{action} failed : {error}') from error
+            self.limiter.update(key, response)
+            self.count(route, response.status_code, started - waited, time.perf_counter() - started)
+
+            if response.status_code != 429 or attempt == RATE_LIMIT_RETRIES:
+                break
+
+        if expected is not None and response.status_code not in expected:
+            raise TransportError(
+                f'{action} failed : {response.status_code} {response.text}', response)
+
+        return response
+
+    def route_label(self, method, url, key):
+        """
+        :return: the name of the endpoint of a request in the metrics: its generic
+        route for the Discord API, only its host for the others (CDN, uploads).
+        """
+
+        if url.startswith(self.base_url):
+            base = urlsplit(self.base_url)
+            return f'{method} {key[1][len(base.netloc + base.path):]}'
+        return f'{method} {urlsplit(url).netloc}'
+
+    def count(self, route, status, waited, elapsed):
+        """ Record a request in the metrics, if any """
+
+        if self.metrics is None:
+            return
+        self.metrics.inc('http_requests_total', route=route, status=status)
+        if status == 429:
+            self.metrics.inc('http_rate_limited_total', route=route)
+        self.metrics.observe('http_request_seconds', elapsed, route=route)
+        self.metrics.observe('http_rate_limit_wait_seconds', waited, route=route)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def close(self):
+        """ Close every pooled connection """
+
+        self.session.close()
+
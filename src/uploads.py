@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------
+# uploads.py - Streamed and resumable attachment uploads.
+# --------------------------------------------------
+# Built-in
+import os
+import threading
+import time
+
+from .transport import TransportError
+
+# Resumable upload chunks must be a multiple of 256 KiB
+UPLOAD_CHUNK = 8 * 256 * 1024
+# Times a chunk is retried (after asking what the server received) before giving up
+UPLOAD_RETRIES = 5
+
+
+def format_size(size):
+    """
+    :param size: A number of bytes.
+    :return: the size in a human readable format (ex: 1.5 MB).
+    """
+
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
+
+
+class UploadProgress():
+    """ Bytes sent by the uploads of a single `:attach:` command """
+
+    def __init__(self, total):
+        """
+        :param total: Size (bytes) of all the files to upload.
+        """
+
+        self.total = total
+        self.sent = 0
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def advance(self, size):
+        """ Count `size` more bytes as sent (negative when a chunk is sent again) """
+
+        with self.lock:
+            self.sent += size
+
+    def throughput(self):
+        """ :return: the average upload speed in bytes per second. """
+
+        return self.sent / max(time.monotonic() - self.started, 1e-6)
+
+    def __str__(self):
+        percent = 100 * self.sent / self.total if self.total else 100
+        return (f'{percent:.0f}% - {format_size(self.sent)}/{format_size(self.total)}'
+                f' - {format_size(self.throughput())}/s')
+
+
+def received_offset(response, size):
+    """
+    :param response: Answer of the upload server to a chunk or a status query.
+    :param size: Size of the file.
+    :return: the number of bytes the server holds.
+    """
+
+    if response.status_code in (200, 201):
+        return size
+
+    # 308 Resume Incomplete, 'Range: bytes=0-<last byte received>'
+    received = response.headers.get('Range')
+    return int(received.split('-')[1]) + 1 if received else 0
+
+
+def upload_file(http, path, upload_url, progress=None):
+    """
+    Upload a file to a resumable upload URL, one chunk in memory at a time. After a
+    failed chunk, the server is asked how much it received and the upload resumes
+    from there.
+
+    :param http: The `Transport` to send the chunks with.
+    :param path: Path of the file to upload.
+    :param upload_url: Upload URL given by Discord.
+    :param progress: `UploadProgress` to report the bytes sent to.
+    """
+
+    size = os.path.getsize(path)
+    if size == 0:
+        http.put(upload_url, data=b'', expected=(200, 201), action='Put attachment')
+        return
+
+    offset = 0
+    failures = 0
+    with open(path, 'rb') as f:
+        while offset < size:
+            f.seek(offset)
+            chunk = f.read(UPLOAD_CHUNK)
+            headers = {'Content-Range': f'bytes {offset}-{offset + len(chunk) - 1}/{size}'}
+            try:
+                response = http.put(
+                    upload_url,
+                    data=chunk,
+                    headers=headers,
+                    expected=(200, 201, 308),
+                    timeout=60,
+                    action='Put attachment'
+                )
+            except TransportError:
+                failures += 1
+                if failures > UPLOAD_RETRIES:
+                    raise
+                time.sleep(min(2 ** failures, 30))
+                try:
+                    response = http.put(
+                        upload_url,
+                        headers={'Content-Range': f'bytes */{size}'},
+                        expected=(200, 201, 308),
+                        action='Put attachment'
+                    )
+                except TransportError:
+                    continue
+
+            received = received_offset(response, size)
+            if progress:
+                progress.advance(received - offset)
+            offset = received
@@ -0,0 +1,515 @@
+import base64
+import hashlib
+import json
+import re
+import socket
+import sqlite3
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+import pytest
+
+from src.archive import MessageArchive, date_snowflake, page_span
+from src.gateway import Gateway
+from src.main import MyClient
+from src.model import Message
+from src.outbox import Outbox
+from src.ratelimit import BACKGROUND, INTERACTIVE, RateLimiter, route_key
+from src.scheduler import PollScheduler
+from src.store import MessageDelta, MessageStore
+from src.transport import TransportError
+from src.uploads import UPLOAD_CHUNK, UploadProgress, upload_file
+
+
+class StandInGateway():
+    """ Local WebSocket server replaying recorded gateway events, one script per connection """
+
+    def __init__(self):
+        self.scripts = []
+        self.received = []
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen()
+        self.base_url = f'ws://127.0.0.1:{self.sock.getsockname()[1]}'
+        self.url = f'{self.base_url}/?v=9&encoding=json'
+
+    def start(self, scripts):
+        self.scripts = scripts
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        for script in self.scripts:
+            conn, _ = self.sock.accept()
+            request = b''
+            while b'\r\n\r\n' not in request:
+                request += conn.recv(1024)
+            key = [line.split(b': ')[1] for line in request.split(b'\r\n')
+                   if line.lower().startswith(b'sec-websocket-key')][0]
+            accept = base64.b64encode(hashlib.sha1(
+                key + b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11').digest())
+            conn.sendall(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n'
+                         b'Connection: Upgrade\r\nSec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+
+            self.send(conn, {'op': 10, 'd': {'heartbeat_interval': 45000}})
+            self.received.append(self.receive(conn))
+            for payload in script:
+                self.send(conn, payload)
+            conn.close()
+        self.sock.close()
+
+    def send(self, conn, payload):
+        data = json.dumps(payload).encode()
+        if len(data) < 126:
+            header = struct.pack('!BB', 0x81, len(data))
+        else:
+            header = struct.pack('!BBH', 0x81, 126, len(data))
+        conn.sendall(header + data)
+
+    def receive(self, conn):
+        while True:
+            header = conn.recv(2)
+            length = header[1] & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', conn.recv(2))[0]
+            mask = conn.recv(4)
+            data = b''
+            while len(data) < length:
+                data += conn.recv(length - len(data))
+            payload = json.loads(bytes(b ^ mask[i % 4] for i, b in enumerate(data)))
+            if payload['op'] != 1:
+                return payload
+
+
+def test_gateway_dispatches_and_resumes():
+    message = {'id': '2', 'channel_id': '1', 'content': 'hi'}
+    server = StandInGateway()
+    server.start([
+        [
+            {'op': 0, 's': 1, 't': 'READY', 'd': {
+                'session_id': 'abc', 'resume_gateway_url': server.base_url}},
+            {'op': 0, 's': 2, 't': 'MESSAGE_CREATE', 'd': message},
+        ],
+        [
+            {'op': 0, 's': 3, 't': 'RESUMED', 'd': {}},
+            {'op': 0, 's': 4, 't': 'MESSAGE_DELETE', 'd': {'id': '2', 'channel_id': '1'}},
+        ],
+    ])
+
+    events = []
+    done = threading.Event()
+
+    def on_dispatch(event, data):
+        events.append((event, data))
+        if event == 'MESSAGE_DELETE':
+            done.set()
+
+    gateway = Gateway('token', on_dispatch, url=server.url)
+    gateway.start()
+    assert done.wait(10)
+    gateway.stop()
+
+    assert [event for event, _ in events] == ['READY', 'MESSAGE_CREATE', 'RESUMED', 'MESSAGE_DELETE']
+    assert events[1][1] == message
+    assert server.received[0]['op'] == 2
+    assert server.received[1] == {'op': 6, 'd': {'token': 'token', 'session_id': 'abc', 'seq': 2}}
+
+
+def test_gateway_reports_errors_and_disconnects():
+    server = StandInGateway()
+    server.start([
+        [
+            {'op': 0, 's': 1, 't': 'READY', 'd': {
+                'session_id': 'abc', 'resume_gateway_url': server.base_url}},
+            {'op': 0, 's': 2, 't': 'MESSAGE_CREATE', 'd': {'id': '2'}},
+        ],
+        # Resumed after the disconnection, where the test stops
+        [],
+    ])
+
+    errors = []
+    disconnected = threading.Event()
+
+    def on_dispatch(event, data):
+        if event == 'MESSAGE_CREATE':
+            raise KeyError('channel_id')
+
+    gateway = Gateway('token', on_dispatch, url=server.url,
+                      on_error=lambda event, error: errors.append((event, error)),
+                      on_disconnect=disconnected.set)
+    gateway.start()
+    assert disconnected.wait(10)
+    gateway.stop()
+
+    assert [(event, type(error)) for event, error in errors] == [('MESSAGE_CREATE', KeyError)]
+
+
+def message(message_id, content='hi', edited=None):
+    return Message(str(message_id), '1', '5', 'bob', content=content, edited_timestamp=edited)
+
+
+def test_store_merge_inserts_in_order_and_detects_edits():
+    store = MessageStore()
+
+    delta = store.merge([message(3), message(1), message(2)])
+    assert [m.id for m in delta.inserted] == ['1', '2', '3']
+    assert [m.id for m in store.values()] == ['1', '2', '3']
+    assert store.newest_id == '3'
+
+    delta = store.merge([message(2, 'edited', '2024-01-01'), message(3), message(4)])
+    assert [m.id for m in delta.inserted] == ['4']
+    assert [m.content for m in delta.edited] == ['edited']
+    assert not delta.deleted
+    assert store.get(2).content == 'edited'
+
+
+def test_store_complete_merge_deletes_within_the_window_only():
+    store = MessageStore()
+    store.merge([message(message_id) for message_id in range(1, 6)])
+
+    # The window starts at 3: 1 and 2 are older, not deleted
+    delta = store.merge([message(3), message(5)], complete=True)
+    assert [m.id for m in delta.deleted] == ['4']
+    assert [m.id for m in store.values()] == ['1', '2', '3', '5']
+    assert 4 not in store
+
+    assert not store.merge([], complete=False)
+
+
+def test_store_keeps_the_newest_messages():
+    store = MessageStore(limit=3)
+    store.merge([message(message_id) for message_id in range(1, 6)])
+
+    assert [m.id for m in store.values()] == ['3', '4', '5']
+    assert len(store) == 3
+    assert store.get(1) is None
+
+    delta = store.update({'id': '5', 'content': 'new', 'edited_timestamp': '2024-01-01'})
+    assert [m.content for m in delta.edited] == ['new']
+    assert not store.update({'id': '1', 'content': 'gone'})
+
+
+class FakeResponse():
+    def __init__(self, status_code=200, headers=None, body=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.body = body
+
+    def json(self):
+        if self.body is None:
+            raise ValueError('no body')
+        return self.body
+
+
+MESSAGES_URL = 'https://discord.com/api/v9/channels/{}/messages'
+
+
+def test_rate_limiter_learns_buckets_from_headers():
+    limiter = RateLimiter()
+    first = route_key('GET', MESSAGES_URL.format(111111111111111111))
+    other = route_key('GET', MESSAGES_URL.format(222222222222222222))
+    assert first[1] == other[1] and first[2] != other[2]
+
+    assert limiter.delay(first, INTERACTIVE, time.monotonic()) == 0
+    limiter.update(first, FakeResponse(headers={
+        'X-RateLimit-Bucket': 'abc', 'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset-After': '2'
+    }))
+    now = time.monotonic()
+    assert 0 < limiter.delay(first, INTERACTIVE, now) <= 2
+    # Same route, other channel: its own bucket
+    assert limiter.delay(other, INTERACTIVE, now) == 0
+    # Once reset, what was known of the bucket is forgotten
+    assert limiter.delay(first, INTERACTIVE, now + 3) == 0
+
+
+def test_rate_limiter_global_and_route_429():
+    limiter = RateLimiter()
+    first = route_key('GET', MESSAGES_URL.format(111111111111111111))
+    other = route_key('GET', MESSAGES_URL.format(222222222222222222))
+
+    limiter.update(first, FakeResponse(429, body={'retry_after': 5}))
+    now = time.monotonic()
+    assert limiter.delay(first, INTERACTIVE, now) > 4
+    assert limiter.delay(other, INTERACTIVE, now) == 0
+
+    limiter.update(other, FakeResponse(429, {'X-RateLimit-Global': 'true', 'Retry-After': '1'}))
+    now = time.monotonic()
+    assert 0 < limiter.delay(other, INTERACTIVE, now) <= 1
+    assert 0 < limiter.delay(route_key('GET', 'https://discord.com/api/v9/users/@me'), BACKGROUND, now) <= 1
+
+
+def test_rate_limiter_background_waits_for_interactive():
+    limiter = RateLimiter()
+    busy = route_key('POST', MESSAGES_URL.format(111111111111111111))
+    idle = route_key('GET', 'https://discord.com/api/v9/users/333333333333333333')
+    limiter.update(busy, FakeResponse(headers={'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset-After': '0.2'}))
+
+    interactive = threading.Thread(target=limiter.acquire, args=(busy,))
+    interactive.start()
+    while not limiter.interactive_waiting:
+        time.sleep(0.01)
+
+    # Its own bucket is free, but an interactive request is queued
+    assert limiter.delay(idle, BACKGROUND, time.monotonic()) is None
+    started = time.monotonic()
+    limiter.acquire(idle, BACKGROUND)
+    # Only sent once the interactive request got its bucket back
+    assert time.monotonic() - started > 0.1
+    assert not limiter.interactive_waiting
+    interactive.join()
+
+
+def test_page_span():
+    page = [message(message_id) for message_id in (10, 11, 12)]
+
+    assert page_span(page, 3) == (10, 12)
+    # A short page is the beginning of the channel
+    assert page_span(page, 50) == (0, 12)
+    assert page_span(page, 3, before=20) == (10, 20)
+    assert page_span(page, 50, after=5) == (5, 12)
+    assert page_span([], 50, after=5) is None
+    assert page_span([], 50, before=20) == (0, 20)
+    assert page_span([], 50) is None
+
+
+def test_archive_merges_spans_and_serves_history():
+    archive = MessageArchive(':memory:')
+    archive.store(1, [message(message_id) for message_id in range(20, 30)], span=(20, 29))
+    archive.store(1, [message(message_id) for message_id in range(10, 20)], span=(10, 20))
+    archive.store(1, [message(40)], span=(40, 40))
+
+    spans = archive.db.execute('SELECT lowest, highest FROM spans ORDER BY lowest').fetchall()
+    assert spans == [(10, 29), (40, 40)]
+
+    assert [m.id for m in archive.history(1, 25, 5)] == ['20', '21', '22', '23', '24']
+    # Not enough messages held before 15, and a gap before 40
+    assert archive.history(1, 15, 10) is None
+    assert archive.history(1, 40, 5) is None
+    assert archive.history(2, 25, 5) is None
+
+    archive.store(1, [message(message_id) for message_id in range(1, 10)], span=(0, 9))
+    assert [m.id for m in archive.history(1, 5, 10)] == ['1', '2', '3', '4']
+
+
+def test_archive_search_filters():
+    archive = MessageArchive(':memory:')
+    if not archive.searchable:
+        pytest.skip('SQLite without FTS5')
+
+    march = date_snowflake('2024-03-01')
+    april = date_snowflake('2024-04-01')
+    archive.store(1, [
+        Message(str(march + 1), '1', '5', 'bob', content='deploy failed'),
+        Message(str(april + 1), '1', '6', 'alice', content='deploy fixed'),
+    ])
+    archive.store(2, [Message(str(april + 2), '2', '5', 'bob', content='deployment done')])
+
+    def search(*words, **filters):
+        return [m.content for m in archive.search(words, **filters)]
+
+    assert search('deploy') == ['deploy fixed', 'deploy failed']
+    assert search('deploy*') == ['deployment done', 'deploy fixed', 'deploy failed']
+    assert search('deploy*', channel=1) == ['deploy fixed', 'deploy failed']
+    assert search('deploy*', author='bob') == ['deployment done', 'deploy failed']
+    assert search('deploy', after='2024-04-01') == ['deploy fixed']
+    assert search('deploy', before='2024-04-01') == ['deploy failed']
+    assert search(author='ali*') == ['deploy fixed']
+
+
+def test_archive_migrates_v1(tmp_path):
+    path = str(tmp_path / 'archive.db')
+    db = sqlite3.connect(path)
+    db.executescript('''
+        CREATE TABLE messages (id INTEGER PRIMARY KEY, channel_id INTEGER NOT NULL, data TEXT NOT NULL);
+        CREATE INDEX messages_channel ON messages (channel_id, id);
+        CREATE TABLE spans (channel_id INTEGER NOT NULL, lowest INTEGER NOT NULL, highest INTEGER NOT NULL);
+        CREATE INDEX spans_channel ON spans (channel_id);
+        PRAGMA user_version = 1;
+    ''')
+    db.execute('INSERT INTO messages VALUES (7, 1, ?)', (json.dumps(message(7, 'old news').to_json()),))
+    db.execute('INSERT INTO spans VALUES (1, 0, 7)')
+    db.commit()
+    db.close()
+
+    archive = MessageArchive(path)
+    assert archive.db.execute('PRAGMA user_version').fetchone()[0] == 2
+    assert archive.db.execute('SELECT content, author FROM messages').fetchall() == [('old news', 'bob')]
+    assert [m.content for m in archive.history(1, 8, 10)] == ['old news']
+    if archive.searchable:
+        assert [m.id for m in archive.search(['news'])] == ['7']
+    archive.close()
+
+
+def test_scheduler_backs_off_idle_channels():
+    scheduler = PollScheduler(poll=None, floor=1, ceiling=5)
+    scheduler.watch('1')
+    assert scheduler.interval('1') == 1
+
+    intervals = []
+    for _ in range(4):
+        scheduler.adapt('1', False)
+        intervals.append(scheduler.interval('1'))
+    assert intervals == [2, 4, 5, 5]
+
+    # A failed poll keeps the interval, activity brings it back to the floor
+    scheduler.adapt('1', None)
+    assert scheduler.interval('1') == 5
+    scheduler.adapt('1', True)
+    assert scheduler.interval('1') == 1
+
+    scheduler.adapt('1', False)
+    scheduler.bump('1')
+    assert scheduler.interval('1') == 1
+
+    scheduler.unwatch('1')
+    assert scheduler.interval('1') is None
+
+
+def test_scheduler_survives_failing_polls():
+    polled = []
+    errors = []
+
+    def poll(channel):
+        polled.append(channel)
+        if channel == 'broken':
+            raise ValueError('closing tag [/x] has nothing to close')
+        return False
+
+    scheduler = PollScheduler(poll, floor=0.01, ceiling=0.01, budget=1000,
+                              on_error=lambda channel, error: errors.append((channel, error)))
+    scheduler.watch('broken', now=True)
+    scheduler.watch('fine', now=True)
+    scheduler.start()
+    time.sleep(0.2)
+    scheduler.stop()
+
+    assert polled.count('broken') > 1 and polled.count('fine') > 1
+    assert errors[0][0] == 'broken' and isinstance(errors[0][1], ValueError)
+    assert not scheduler.thread.is_alive()
+
+
+def failure(status_code):
+    return TransportError(f'Send message failed : {status_code} error', FakeResponse(status_code))
+
+
+class Recorder():
+    """ Callbacks of an `Outbox`, recorded """
+
+    def __init__(self):
+        self.sent = []
+        self.failed = []
+
+    def on_sent(self, channel, nonce, message):
+        self.sent.append((channel, message['content']))
+
+    def on_failed(self, channel, nonce, content, error):
+        self.failed.append((channel, content, error.status_code))
+
+
+def test_outbox_retries_transient_errors_in_order():
+    attempts = []
+
+    def send(content, channel, nonce):
+        attempts.append(content)
+        if attempts.count(content) < 3 and content == 'first':
+            raise failure(502)
+        return {'id': nonce, 'content': content}
+
+    recorder = Recorder()
+    outbox = Outbox(send, recorder.on_sent, recorder.on_failed, backoff=0.01)
+    outbox.put('1', 'first')
+    outbox.put('1', 'second')
+    assert outbox.join(5)
+
+    # Retried before the next message of the channel is sent
+    assert attempts == ['first', 'first', 'first', 'second']
+    assert recorder.sent == [('1', 'first'), ('1', 'second')]
+    assert not recorder.failed
+
+
+def test_outbox_gives_up_on_errors():
+    attempts = []
+
+    def send(content, channel, nonce):
+        attempts.append(content)
+        raise failure(400 if content == 'rejected' else 503)
+
+    recorder = Recorder()
+    outbox = Outbox(send, recorder.on_sent, recorder.on_failed, backoff=0.01)
+    outbox.put('1', 'rejected')
+    assert outbox.join(5)
+    assert attempts == ['rejected']
+    assert recorder.failed == [('1', 'rejected', 400)]
+
+    # Waiting for a retry when closed
+    outbox.backoff = 10
+    outbox.put('2', 'unavailable')
+    while 'unavailable' not in attempts:
+        time.sleep(0.01)
+    outbox.close()
+    assert outbox.join(5)
+    assert recorder.failed[-1] == ('2', 'unavailable', 503)
+    assert not recorder.sent
+
+
+def test_reconcile_drops_messages_already_printed():
+    client = MyClient.__new__(MyClient)
+    client.user_id = '5'
+    client.pending = OrderedDict()
+    client.echoed = OrderedDict()
+
+    for nonce, content in (('n1', 'by nonce'), ('n2', 'by content'), ('n3', 'still pending')):
+        client.pending[nonce] = Message(nonce, '1', '5', 'bob', content=content, nonce=nonce)
+    client.echoed['20'] = '1'
+
+    gateway = Message('10', '1', '5', 'bob', content='by nonce', nonce='n1')
+    # Polls carry no nonce: matched by author and content
+    poll = Message('11', '1', '5', 'bob', content='by content')
+    other = Message('12', '1', '6', 'alice', content='still pending')
+    sent = Message('20', '1', '5', 'bob', content='answered')
+
+    delta = client.reconcile(MessageDelta([gateway, poll, other, sent]))
+    assert [m.id for m in delta.inserted] == ['12']
+    assert list(client.pending) == ['n3']
+    assert not client.echoed
+
+
+class FlakyUploadServer():
+    """ Resumable upload endpoint, dropping the connection in the middle of one chunk """
+
+    def __init__(self, fail_on):
+        self.received = bytearray()
+        self.puts = 0
+        self.fail_on = fail_on
+
+    def put(self, url, data=b'', headers=None, **kwargs):
+        self.puts += 1
+        start, end, size = re.fullmatch(
+            r'bytes (\d+|\*)-?(\d*)/(\d+)', headers['Content-Range']).groups()
+        if start != '*' and int(start) == len(self.received):
+            if self.puts == self.fail_on:
+                # Only half of the chunk got through
+                self.received += data[:len(data) // 2]
+                raise TransportError('Put attachment failed : None connection reset')
+            self.received += data
+
+        if len(self.received) == int(size):
+            return FakeResponse(200)
+        return FakeResponse(308, {'Range': f'bytes=0-{len(self.received) - 1}'})
+
+
+def test_upload_resumes_after_a_failed_chunk(tmp_path, monkeypatch):
+    monkeypatch.setattr('src.uploads.time.sleep', lambda seconds: None)
+    content = bytes(range(256)) * (UPLOAD_CHUNK * 3 // 256 + 100)
+    path = tmp_path / 'file.bin'
+    path.write_bytes(content)
+
+    server = FlakyUploadServer(fail_on=2)
+    progress = UploadProgress(len(content))
+    upload_file(server, str(path), 'https://upload', progress)
+
+    assert bytes(server.received) == content
+    assert progress.sent == progress.total == len(content)
+    # Chunk, failed chunk, status query, then two chunks from the middle of the failed one
+    assert server.puts == 5